@@ -1,5 +1,7 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_from_directory, send_file, Response, g
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, tuple_, event, text
+from sqlalchemy.exc import OperationalError
 from flask_migrate import Migrate
 from flask_login import (
     LoginManager,
@@ -11,28 +13,89 @@ from flask_login import (
 )
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+import cProfile
 import json
 import os
+import re
+import time
+import uuid
 from datetime import datetime
-from process_audio import run
+from process_audio import run, get_backend, get_cache, categorize, transcribe_stream, STREAM_SAMPLE_RATE, CategorizationError
+from cache import text_digest
+import metrics
+from jobs import JobQueue, QueueFull, PermanentJobError, RetryJob
+from dictation import DictationSessions, TooManyDictations, DictationClosed, FINAL_STATUSES
+from database import database_uri, engine_options, configure_engine, sync_id_sequence
+from audio_archive import AudioArchive
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your_secure_random_secret_key'  # Replace with a secure key
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///patients.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = database_uri(os.environ.get('DATABASE_URL', 'sqlite:///patients.db'))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# Configuration for the database engine (see database.py)
+app.config['DATABASE_POOL_SIZE'] = int(os.environ.get('DATABASE_POOL_SIZE', 10))  # Connections kept open per process
+app.config['DATABASE_MAX_OVERFLOW'] = int(os.environ.get('DATABASE_MAX_OVERFLOW', 20))  # Extra connections allowed under load
+app.config['DATABASE_POOL_TIMEOUT'] = int(os.environ.get('DATABASE_POOL_TIMEOUT', 30))  # Seconds to wait for a free connection
+app.config['DATABASE_POOL_RECYCLE'] = int(os.environ.get('DATABASE_POOL_RECYCLE', 1800))  # Seconds before a connection is replaced
+app.config['SQLITE_BUSY_TIMEOUT'] = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))  # ms to wait for another writer
+app.config['SQLITE_JOURNAL_MODE'] = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+app.config['SQLITE_SYNCHRONOUS'] = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+app.config['SQLITE_CACHE_SIZE_KB'] = int(os.environ.get('SQLITE_CACHE_SIZE_KB', 20000))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+
 # Configuration for file uploads
 ALLOWED_EXTENSIONS = {'mp3', 'wav', 'ogg'}
 UPLOAD_FOLDER = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'uploads', 'audio')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # Max 16 MB upload size
 
+# Configuration for the archive of recordings notes were made from (see audio_archive.py)
+app.config['AUDIO_ARCHIVE_FOLDER'] = os.environ.get(
+    'AUDIO_ARCHIVE_FOLDER', os.path.join(os.path.abspath(os.path.dirname(__file__)), 'uploads', 'archive'))
+app.config['AUDIO_ARCHIVE_BITRATE'] = os.environ.get('AUDIO_ARCHIVE_BITRATE', '32k')  # Opus bitrate; 24k-32k is plenty for speech
+app.config['AUDIO_ARCHIVE_MAX_AGE'] = 7 * 24 * 3600  # Archived files never change, so browsers may cache them
+
+# Configuration for background transcription jobs. Jobs and live dictations are
+# kept in memory, so the app must run as ONE process (threads are fine, e.g.
+# gunicorn --workers 1 --threads 8): with several processes a /jobs/<id> poll or
+# a /dictation/<id> request can reach a process that has never heard of it
+app.config['TRANSCRIPTION_WORKERS'] = 2  # Notes processed at the same time
+app.config['TRANSCRIPTION_QUEUE_SIZE'] = 32  # Uploads allowed to wait for a worker
+app.config['TRANSCRIPTION_MAX_RETRIES'] = 2
+
+# Configuration for live dictation
+app.config['DICTATION_MAX_SESSIONS'] = 16  # Dictations in progress at the same time
+app.config['DICTATION_IDLE_TIMEOUT'] = 300  # Seconds before an abandoned dictation is dropped
+app.config['DICTATION_WORKERS'] = 4  # Chunks transcribed at the same time across all dictations
+DICTATION_KEEPALIVE = 15  # Seconds between keep-alive comments on the event stream
+
+# Page sizes for the lazily loaded patient list and note history
+app.config['PATIENTS_PAGE_SIZE'] = 50
+app.config['NOTES_PAGE_SIZE'] = 20
+MAX_PAGE_SIZE = 200
+
+# Patients imported per transaction by import_data
+IMPORT_BATCH_SIZE = 500
+
+# Requests slower than this many seconds get a cProfile trace written to
+# PROFILE_DIR (0 turns profiling off; it slows every request down)
+app.config['PROFILE_SLOW_REQUESTS'] = float(os.environ.get('PROFILE_SLOW_REQUESTS', 0))
+app.config['PROFILE_DIR'] = os.path.join(app.instance_path, 'profiles')
+
 # Ensure the upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
 # Initialize extensions
 db = SQLAlchemy(app)
-migrate = Migrate(app, db)
+with app.app_context():
+    configure_engine(db.engine, app.config)
+# Tables created by raw DDL rather than the models (the full-text index and
+# its shadow tables) are left alone by 'flask db migrate'
+def include_object(object, name, type_, reflected, compare_to):
+    return not (type_ == 'table' and name.startswith('doctor_note_fts'))
+
+migrate = Migrate(app, db, include_object=include_object)
 
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -50,7 +113,7 @@ class Patient(db.Model):
     name = db.Column(db.String(50), nullable=False)
     age = db.Column(db.Integer, nullable=False)
 
-# DoctorNote model (Updated to exclude audio_file)
+# DoctorNote model; the recording it was made from (if kept) is in the audio archive under audio_digest
 class DoctorNote(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
@@ -61,9 +124,197 @@ class DoctorNote(db.Model):
     intervention = db.Column(db.Text, nullable=False)
     other = db.Column(db.Text, nullable=False)
     date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    audio_digest = db.Column(db.String(64), nullable=True, index=True)
 
     patient = db.relationship('Patient', backref=db.backref('doctor_notes', lazy=True))
 
+# Index for the patient details view: one patient's notes, newest first
+# (id breaks ties between notes with the same date for keyset pagination)
+db.Index('ix_doctor_note_patient_id_date_id', DoctorNote.patient_id, DoctorNote.date.desc(), DoctorNote.id.desc())
+
+NOTE_FIELDS = ('subjective', 'objective', 'assessment', 'plan', 'intervention', 'other')
+
+# Full-text index over the note fields (SQLite FTS5). It is an external-content
+# table, so the text is only stored in doctor_note; the triggers keep the index
+# in step with every insert, update and delete, including import_data's bulk inserts
+_search_columns = ', '.join(NOTE_FIELDS)
+_new_values = ', '.join('new.' + field for field in NOTE_FIELDS)
+_old_values = ', '.join('old.' + field for field in NOTE_FIELDS)
+NOTE_SEARCH_DDL = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS doctor_note_fts USING fts5({_search_columns}, "
+    f"content='doctor_note', content_rowid='id', tokenize='porter unicode61')",
+    f"CREATE TRIGGER IF NOT EXISTS doctor_note_fts_insert AFTER INSERT ON doctor_note BEGIN "
+    f"INSERT INTO doctor_note_fts(rowid, {_search_columns}) VALUES (new.id, {_new_values}); END",
+    f"CREATE TRIGGER IF NOT EXISTS doctor_note_fts_delete AFTER DELETE ON doctor_note BEGIN "
+    f"INSERT INTO doctor_note_fts(doctor_note_fts, rowid, {_search_columns}) VALUES ('delete', old.id, {_old_values}); END",
+    f"CREATE TRIGGER IF NOT EXISTS doctor_note_fts_update AFTER UPDATE ON doctor_note BEGIN "
+    f"INSERT INTO doctor_note_fts(doctor_note_fts, rowid, {_search_columns}) VALUES ('delete', old.id, {_old_values}); "
+    f"INSERT INTO doctor_note_fts(rowid, {_search_columns}) VALUES (new.id, {_new_values}); END",
+]
+
+# PostgreSQL equivalent: a GIN index on the notes' tsvector. Queries must use
+# exactly this expression for the index to be used
+NOTE_SEARCH_DOCUMENT = "to_tsvector('english', " + " || ' ' || ".join(NOTE_FIELDS) + ")"
+POSTGRES_NOTE_SEARCH_DDL = [
+    f"CREATE INDEX IF NOT EXISTS ix_doctor_note_search ON doctor_note USING gin ({NOTE_SEARCH_DOCUMENT})",
+]
+
+# Create the index along with the doctor_note table
+@event.listens_for(DoctorNote.__table__, 'after_create')
+def create_note_search_index(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        statements = NOTE_SEARCH_DDL
+    elif connection.dialect.name == 'postgresql':
+        statements = POSTGRES_NOTE_SEARCH_DDL
+    else:
+        return
+    for statement in statements:
+        connection.exec_driver_sql(statement)
+
+# Add the index to a database created before it existed and index the notes already there
+def ensure_note_search_index():
+    with db.engine.begin() as connection:
+        if connection.dialect.name == 'sqlite':
+            exists = connection.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'doctor_note_fts'").first()
+        elif connection.dialect.name == 'postgresql':
+            exists = connection.exec_driver_sql(
+                "SELECT 1 FROM pg_indexes WHERE tablename = 'doctor_note' AND indexname = 'ix_doctor_note_search'").first()
+        else:
+            return
+        if not exists:
+            create_note_search_index(DoctorNote.__table__, connection)
+            if connection.dialect.name == 'sqlite':
+                connection.exec_driver_sql("INSERT INTO doctor_note_fts(doctor_note_fts) VALUES ('rebuild')")
+            print("Built the note search index.")
+
+# Job function: turn an uploaded recording (or a transcript of a streamed one) into note fields
+def transcribe_note(file_path=None, transcript=None):
+    if transcript is not None:
+        note_data = categorize(transcript, cache=get_cache())
+    else:
+        try:
+            note_data = run(file_path)
+        except CategorizationError as e:
+            # run() raises this for any failure once the audio is transcribed;
+            # retry from the transcript instead of processing the audio again
+            raise RetryJob(str(e), transcript=e.transcript)
+    if not note_data:
+        raise PermanentJobError('No speech could be transcribed from the recording.')
+    return note_data
+
+# Save the note fields produced from a recording as a new DoctorNote
+@metrics.span('save_note')
+def save_note(patient_id, note_data, audio_digest=None):
+    new_note = DoctorNote(
+        patient_id=patient_id,
+        subjective=note_data['subjective'],
+        objective=note_data['objective'],
+        assessment=note_data['assessment'],
+        plan=note_data['plan'],
+        intervention=note_data['intervention'],
+        other=note_data['other'],
+        date=datetime.utcnow(),
+        audio_digest=audio_digest
+    )
+    db.session.add(new_note)
+    db.session.commit()
+    return new_note
+
+# Called by a worker once transcribe_note succeeds: archive the recording and save the DoctorNote
+def save_transcribed_note(job):
+    try:
+        audio_digest = archive_upload(job.kwargs.get('file_path'))
+        with app.app_context():
+            new_note = save_note(job.context['patient_id'], job.result, audio_digest=audio_digest)
+            job.context['note_id'] = new_note.id
+    finally:
+        discard_upload(job.kwargs.get('file_path'))
+
+# Keep a compressed copy of an upload before it is deleted; a recording that
+# cannot be archived is reported but does not cost the nurse the note
+def archive_upload(file_path):
+    if not file_path or not os.path.exists(file_path):
+        return None
+    try:
+        return audio_archive.store(file_path)
+    except Exception as e:
+        print(f"Could not archive {file_path}: {e}")
+        return None
+
+# Called by a worker once a job has run out of retries
+def discard_transcription(job):
+    discard_upload(job.kwargs.get('file_path'))
+
+# A new path in UPLOAD_FOLDER for an upload. Uploads wait in the job queue, so
+# two with the same name (even from the same nurse in the same second) must
+# never share a file
+def new_upload_path(filename):
+    return os.path.join(app.config['UPLOAD_FOLDER'], f"{uuid.uuid4().hex}_{secure_filename(filename)}")
+
+def discard_upload(file_path):
+    if file_path and os.path.exists(file_path):
+        os.remove(file_path)
+
+audio_archive = AudioArchive(app.config['AUDIO_ARCHIVE_FOLDER'], bitrate=app.config['AUDIO_ARCHIVE_BITRATE'])
+
+note_jobs = JobQueue(
+    transcribe_note,
+    workers=app.config['TRANSCRIPTION_WORKERS'],
+    max_queue=app.config['TRANSCRIPTION_QUEUE_SIZE'],
+    max_retries=app.config['TRANSCRIPTION_MAX_RETRIES'],
+    on_success=save_transcribed_note,
+    on_failure=discard_transcription,
+)
+
+dictations = DictationSessions(
+    get_backend,
+    max_sessions=app.config['DICTATION_MAX_SESSIONS'],
+    idle_timeout=app.config['DICTATION_IDLE_TIMEOUT'],
+    workers=app.config['DICTATION_WORKERS'],
+)
+
+# Clients that ask for JSON get job ids instead of redirects
+def wants_json():
+    return request.accept_mimetypes.best == 'application/json'
+
+# Time every request, and profile it when PROFILE_SLOW_REQUESTS is set
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if app.config['PROFILE_SLOW_REQUESTS']:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Only one profiler can run at a time (Python 3.12+); skip this request
+            return
+        g.profiler = profiler
+
+@app.after_request
+def remember_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+# Runs even when the view raised, so the profiler is always switched off
+@app.teardown_request
+def record_request(exc):
+    if 'request_started' not in g:
+        return
+    elapsed = time.perf_counter() - g.request_started
+    status = 500 if exc is not None else g.get('response_status', 500)
+    metrics.HTTP_REQUEST_SECONDS.observe(elapsed, endpoint=request.endpoint or 'unknown',
+                                         method=request.method, status=status)
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        if elapsed >= app.config['PROFILE_SLOW_REQUESTS']:
+            os.makedirs(app.config['PROFILE_DIR'], exist_ok=True)
+            filename = f"{datetime.utcnow().strftime('%Y%m%d%H%M%S%f')}_{request.endpoint or 'unknown'}.prof"
+            path = os.path.join(app.config['PROFILE_DIR'], filename)
+            profiler.dump_stats(path)
+            print(f"Slow request {request.method} {request.path} took {elapsed:.2f}s, profile written to {path}")
+
 @app.route('/')
 def root():
     return redirect(url_for('login'))
@@ -96,60 +347,149 @@ def helper(audio_path):
         'other': 'Extracted other data from audio.'
     }
 
-# Function to import data from JSON
-def import_data():
-    if os.path.exists('patients.json'):
-        with open('patients.json', 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            for item in data:
-                # Add or update patient
-                patient = Patient.query.get(item['id'])
-                if not patient:
-                    patient = Patient(
-                        id=item['id'],
-                        name=item['name'],
-                        age=item['age']
-                    )
-                    db.session.add(patient)
-                else:
-                    patient.name = item['name']
-                    patient.age = item['age']
-                
-                # Add doctor notes
-                for note in item.get('doctor_notes', []):
-                    # Parse the date string into a datetime object
-                    try:
-                        note_date = datetime.strptime(note['date'], '%Y-%m-%d %H:%M')
-                    except ValueError:
-                        # Handle incorrect date format
-                        print(f"Incorrect date format for patient ID {patient.id}")
-                        continue
-
-                    # Check if the exact note already exists to prevent duplicates
-                    existing_note = DoctorNote.query.filter_by(
-                        patient_id=patient.id,
-                        subjective=note['subjective'],
-                        objective=note['objective'],
-                        assessment=note['assessment'],
-                        plan=note['plan'],
-                        intervention=note['intervention'],
-                        other=note['other'],
-                        date=note_date
-                    ).first()
-                    if not existing_note:
-                        doctor_note = DoctorNote(
-                            patient_id=patient.id,
-                            subjective=note['subjective'],
-                            objective=note['objective'],
-                            assessment=note['assessment'],
-                            plan=note['plan'],
-                            intervention=note['intervention'],
-                            other=note['other'],
-                            date=note_date
-                        )
-                        db.session.add(doctor_note)
+# Hash identifying a note by its patient, date and text, used to skip duplicates on import
+def note_content_hash(patient_id, note_date, note):
+    return text_digest(patient_id, note_date.isoformat(), *(note[field] for field in NOTE_FIELDS))
+
+_NOT_DECODED = object()
+
+# Yield the items of a top-level JSON array one at a time, reading the file in
+# blocks so a large export is never loaded whole
+def iter_json_array(f, block_size=1 << 16):
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    eof = False
+    expect = '['
+    while True:
+        # Skip whitespace, reading more of the file when the buffer runs out
+        while pos < len(buffer) and buffer[pos].isspace():
+            pos += 1
+        if pos == len(buffer):
+            if eof:
+                raise ValueError('Unexpected end of JSON array')
+            buffer = f.read(block_size)
+            pos = 0
+            eof = not buffer
+            continue
+        char = buffer[pos]
+        if expect == '[':
+            if char != '[':
+                raise ValueError('Expected a JSON array')
+            pos += 1
+            expect = 'item'
+        elif char == ']' and expect in ('item', ','):
+            return
+        elif expect == ',':
+            if char != ',':
+                raise ValueError(f'Expected "," in JSON array, got {char!r}')
+            pos += 1
+            expect = 'item'
+        else:
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                item, end = _NOT_DECODED, len(buffer)
+            # An item is only complete once the "," or "]" after it has been read:
+            # one running up to the end of the buffer may be cut short (a number
+            # split as "1." + "5" even decodes), so read more and retry
+            after = end
+            while after < len(buffer) and buffer[after].isspace():
+                after += 1
+            if (after == len(buffer) or buffer[after] not in ',]') and not eof:
+                more = f.read(max(block_size, len(buffer)))
+                buffer = buffer[pos:] + more
+                pos = 0
+                eof = not more
+                continue
+            if item is _NOT_DECODED:
+                raise ValueError('Invalid JSON in array item')
+            yield item
+            pos = end
+            expect = ','
+
+# Import one batch of patients (and their notes) with bulk inserts and updates
+def import_patient_batch(items, totals):
+    # Later entries for the same patient id win, as they did when updating one by one
+    patient_rows = {item['id']: {'id': item['id'], 'name': item['name'], 'age': item['age']} for item in items}
+    existing_ids = {
+        patient_id for (patient_id,) in
+        db.session.query(Patient.id).filter(Patient.id.in_(list(patient_rows)))
+    }
+    db.session.bulk_update_mappings(Patient, [row for patient_id, row in patient_rows.items() if patient_id in existing_ids])
+    db.session.bulk_insert_mappings(Patient, [row for patient_id, row in patient_rows.items() if patient_id not in existing_ids])
+
+    # Hashes of the notes these patients already have, so duplicates are skipped in memory
+    seen = set()
+    if existing_ids:
+        existing_notes = db.session.query(
+            DoctorNote.patient_id,
+            DoctorNote.date,
+            *(getattr(DoctorNote, field) for field in NOTE_FIELDS)
+        ).filter(DoctorNote.patient_id.in_(list(existing_ids)))
+        for row in existing_notes:
+            seen.add(note_content_hash(row.patient_id, row.date, row._mapping))
+
+    new_notes = []
+    for item in items:
+        for note in item.get('doctor_notes', []):
+            # Parse the date string into a datetime object
+            try:
+                note_date = datetime.strptime(note['date'], '%Y-%m-%d %H:%M')
+            except ValueError:
+                # Handle incorrect date format
+                print(f"Incorrect date format for patient ID {item['id']}")
+                continue
+
+            # Skip notes that already exist (or appear twice in the file)
+            content_hash = note_content_hash(item['id'], note_date, note)
+            if content_hash in seen:
+                totals['duplicates'] += 1
+                continue
+            seen.add(content_hash)
+            new_note = {field: note[field] for field in NOTE_FIELDS}
+            new_note['patient_id'] = item['id']
+            new_note['date'] = note_date
+            new_notes.append(new_note)
+    db.session.bulk_insert_mappings(DoctorNote, new_notes)
     db.session.commit()
 
+    totals['patients'] += len(patient_rows)
+    totals['notes'] += len(new_notes)
+
+# Rows read from the export so far (patients plus notes, including skipped duplicates)
+def import_rows(totals):
+    return totals['patients'] + totals['notes'] + totals['duplicates']
+
+# Function to import data from JSON
+def import_data(path='patients.json', batch_size=IMPORT_BATCH_SIZE):
+    totals = {'patients': 0, 'notes': 0, 'duplicates': 0}
+    if not os.path.exists(path):
+        return totals
+    started = time.perf_counter()
+    with open(path, 'r', encoding='utf-8') as f:
+        batch = []
+        for item in iter_json_array(f):
+            batch.append(item)
+            if len(batch) == batch_size:
+                import_patient_batch(batch, totals)
+                batch = []
+                elapsed = time.perf_counter() - started
+                print(f"Imported {totals['patients']} patients, {totals['notes']} notes "
+                      f"({import_rows(totals) / elapsed:.0f} rows/s)")
+        if batch:
+            import_patient_batch(batch, totals)
+    # Patients keep the ids from the export, so PostgreSQL's id sequence has to catch up
+    if totals['patients']:
+        sync_id_sequence(db.session.connection(), Patient.__tablename__)
+        db.session.commit()
+    totals['seconds'] = time.perf_counter() - started
+    totals['rows_per_second'] = import_rows(totals) / totals['seconds'] if totals['seconds'] else 0.0
+    print(f"Import finished: {totals['patients']} patients, {totals['notes']} new notes, "
+          f"{totals['duplicates']} duplicates skipped in {totals['seconds']:.1f}s "
+          f"({totals['rows_per_second']:.0f} rows/s)")
+    return totals
+
 # Function to create predefined doctor accounts
 def create_doctor_accounts():
     with app.app_context():
@@ -171,12 +511,26 @@ def create_doctor_accounts():
         else:
             print("Doctor accounts already exist.")
 
+# Uploads still waiting in UPLOAD_FOLDER when the app starts belonged to jobs
+# that died with the previous process (jobs are only kept in memory)
+def discard_stale_uploads():
+    folder = app.config['UPLOAD_FOLDER']
+    stale = [name for name in os.listdir(folder) if os.path.isfile(os.path.join(folder, name))]
+    for name in stale:
+        discard_upload(os.path.join(folder, name))
+    if stale:
+        print(f"Removed {len(stale)} uploads left over from unfinished transcription jobs.")
+
 # Initialization function
 def initialize():
+    discard_stale_uploads()
     with app.app_context():
         db.create_all()
+        ensure_note_search_index()
         create_doctor_accounts()
         import_data()
+    # load the speech-to-text engine now rather than on the first upload
+    get_backend()
 
 # Login view
 @app.route('/login', methods=['GET', 'POST'])
@@ -205,43 +559,296 @@ def logout():
     flash('You have been logged out.', 'info')
     return redirect(url_for('login'))
 
-# Main patient list view
+# Helper function to read the ?limit= query parameter
+def page_size(default):
+    limit = request.args.get('limit', default, type=int)
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+# Keyset pagination: the patients after patient id `after`, and the cursor for the next page
+def patients_page(after, limit):
+    query = db.session.query(Patient.id, Patient.name)
+    if after is not None:
+        query = query.filter(Patient.id > after)
+    patients = query.order_by(Patient.id).limit(limit + 1).all()
+    next_cursor = patients[limit - 1].id if len(patients) > limit else None
+    return patients[:limit], next_cursor
+
+# Note cursors are "<date>_<id>" of the last note on the previous page
+def encode_note_cursor(date, note_id):
+    return f"{date.strftime('%Y-%m-%dT%H:%M:%S.%f')}_{note_id}"
+
+def decode_note_cursor(cursor):
+    date, note_id = cursor.rsplit('_', 1)
+    return datetime.strptime(date, '%Y-%m-%dT%H:%M:%S.%f'), int(note_id)
+
+# Main patient list view (the first page; the rest is loaded from /api/patients)
 @app.route('/patients')
 @login_required
 def index():
-    patients = Patient.query.all()
-    return render_template('index.html', patients=patients)
+    patients, next_cursor = patients_page(None, app.config['PATIENTS_PAGE_SIZE'])
+    return render_template('index.html', patients=patients, next_cursor=next_cursor)
+
+# AJAX route to fetch the next page of the patient list
+@app.route('/api/patients', methods=['GET'])
+@login_required
+def list_patients():
+    after = request.args.get('after', type=int)
+    patients, next_cursor = patients_page(after, page_size(app.config['PATIENTS_PAGE_SIZE']))
+    return jsonify({
+        'patients': [{'id': patient.id, 'name': patient.name} for patient in patients],
+        'next_cursor': next_cursor
+    })
 
 # AJAX route to fetch patient details
 @app.route('/patient/<int:patient_id>/details', methods=['GET'])
 @login_required
 def get_patient_details_ajax(patient_id):
-    patient = Patient.query.get(patient_id)
-    if not patient:
+    limit = page_size(app.config['NOTES_PAGE_SIZE'])
+    # Only notes older than the cursor (?before=) belong on this page
+    join_condition = DoctorNote.patient_id == Patient.id
+    before = request.args.get('before')
+    if before:
+        try:
+            before_date, before_id = decode_note_cursor(before)
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+        join_condition = and_(join_condition, tuple_(DoctorNote.date, DoctorNote.id) < (before_date, before_id))
+
+    # Fetch the patient and one page of their doctor notes in one query,
+    # selecting plain columns rather than loading ORM objects
+    rows = db.session.query(
+        Patient.name,
+        Patient.age,
+        DoctorNote.id,
+        DoctorNote.date,
+        DoctorNote.subjective,
+        DoctorNote.objective,
+        DoctorNote.assessment,
+        DoctorNote.plan,
+        DoctorNote.intervention,
+        DoctorNote.other,
+        DoctorNote.audio_digest,
+    ).outerjoin(DoctorNote, join_condition) \
+        .filter(Patient.id == patient_id) \
+        .order_by(DoctorNote.date.desc(), DoctorNote.id.desc()) \
+        .limit(limit + 1) \
+        .all()
+    if not rows:
         return jsonify({'error': 'Patient not found'}), 404
 
-    # Fetch all doctor notes for the patient
-    notes = DoctorNote.query.filter_by(patient_id=patient_id).order_by(DoctorNote.date.desc()).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_note_cursor(rows[-1].date, rows[-1].id)
+
     notes_data = []
-    for note in notes:
+    for row in rows:
+        # A patient without notes still comes back as one row with empty note columns
+        if row.date is None:
+            continue
         notes_data.append({
-            'date': note.date.strftime('%Y-%m-%d %H:%M'),
-            'subjective': note.subjective,
-            'objective': note.objective,
-            'assessment': note.assessment,
-            'plan': note.plan,
-            'intervention': note.intervention,
-            'other': note.other
+            'date': row.date.strftime('%Y-%m-%d %H:%M'),
+            'subjective': row.subjective,
+            'objective': row.objective,
+            'assessment': row.assessment,
+            'plan': row.plan,
+            'intervention': row.intervention,
+            'other': row.other,
+            'audio_url': url_for('note_audio', note_id=row.id) if row.audio_digest else None
         })
 
     patient_details = {
-        'name': patient.name,
-        'age': patient.age,
-        'doctor_notes': notes_data
+        'name': rows[0].name,
+        'age': rows[0].age,
+        'doctor_notes': notes_data,
+        'next_cursor': next_cursor
     }
 
     return jsonify(patient_details)
 
+# Turn a search box query into an FTS5 query: every word (or "quoted phrase")
+# must appear, a trailing * matches a prefix and OR/NOT work between terms;
+# anything else is quoted so user input is never parsed as FTS5 syntax
+def note_search_query(query):
+    terms = []
+    for match in re.finditer(r'"([^"]*)"|(\S+)', query):
+        phrase, word = match.groups()
+        if word in ('OR', 'NOT'):
+            terms.append(word)
+            continue
+        prefix = word is not None and word.endswith('*')
+        value = (phrase if phrase is not None else word.rstrip('*')).strip()
+        if value:
+            terms.append('"' + value.replace('"', '""') + '"' + ('*' if prefix else ''))
+    return ' '.join(terms)
+
+# The same query language for PostgreSQL, as a tsquery expression and its
+# parameters: words are stemmed as the index is, "phrases" must appear in
+# order, word* matches a prefix, NOT excludes the next term and OR separates
+# groups of terms that must all appear. Raises ValueError on a dangling OR/NOT
+def note_search_tsquery(query):
+    groups, terms, params = [], [], {}
+    negate = False
+    for match in re.finditer(r'"([^"]*)"|(\S+)', query):
+        phrase, word = match.groups()
+        if word == 'OR':
+            if not terms or negate:
+                raise ValueError('OR needs a term on both sides')
+            groups.append(terms)
+            terms = []
+            continue
+        if word == 'NOT':
+            if not terms or negate:
+                raise ValueError('NOT needs a term on both sides')
+            negate = True
+            continue
+        prefix = word is not None and word.endswith('*')
+        value = (phrase if phrase is not None else word.rstrip('*')).strip()
+        if not value:
+            continue
+        name = f"term{len(params)}"
+        params[name] = value
+        if phrase is not None:
+            term = f"phraseto_tsquery('english', :{name})"
+        elif prefix and re.fullmatch(r'\w+', value):
+            term = f"to_tsquery('english', :{name} || ':*')"
+        else:
+            term = f"plainto_tsquery('english', :{name})"
+        terms.append('!!' + term if negate else term)
+        negate = False
+    if negate or (groups and not terms):
+        raise ValueError('OR and NOT need a term on both sides')
+    if terms:
+        groups.append(terms)
+    return ' || '.join('(' + ' && '.join(group) + ')' for group in groups), params
+
+# One page of search hits from the SQLite index, best first: (id, cursor
+# score, relevance) per note and the highlighted snippet of each
+def search_notes_sqlite(query, limit, after):
+    match = note_search_query(query)
+    params = {'match': match, 'limit': limit}
+    keyset = ''
+    if after:
+        params['score'], params['after_id'] = after
+        keyset = ('AND (bm25(doctor_note_fts) > :score '
+                  'OR (bm25(doctor_note_fts) = :score AND doctor_note_fts.rowid > :after_id))')
+
+    # Rank first using only the index, then fetch snippets for the page
+    hits = db.session.execute(text(
+        'SELECT doctor_note_fts.rowid AS id, bm25(doctor_note_fts) AS score FROM doctor_note_fts '
+        'WHERE doctor_note_fts MATCH :match ' + keyset + ' ORDER BY score, id LIMIT :limit'
+    ), params).all()
+    # bm25 is lower for better matches
+    hits = [(hit.id, hit.score, -hit.score) for hit in hits]
+    snippets = {}
+    if hits:
+        snippets = dict(db.session.execute(text(
+            "SELECT rowid, snippet(doctor_note_fts, -1, '[', ']', '...', 16) FROM doctor_note_fts "
+            "WHERE doctor_note_fts MATCH :match AND rowid IN (" + ', '.join(str(hit[0]) for hit in hits) + ")"
+        ), {'match': match}).all())
+    return hits, snippets
+
+# The same from PostgreSQL's GIN index, ranked by ts_rank_cd
+def search_notes_postgres(query, limit, after):
+    tsquery, terms = note_search_tsquery(query)
+    params = dict(terms, limit=limit)
+    # ts_rank_cd is a real; as a double it survives the round trip through the cursor exactly
+    rank = f"ts_rank_cd({NOTE_SEARCH_DOCUMENT}, q.query)::float8"
+    keyset = ''
+    if after:
+        params['score'], params['after_id'] = after
+        keyset = f'AND ({rank} < :score OR ({rank} = :score AND doctor_note.id > :after_id))'
+    hits = db.session.execute(text(
+        f'WITH q AS (SELECT {tsquery} AS query) '
+        f'SELECT doctor_note.id AS id, {rank} AS score FROM doctor_note, q '
+        f'WHERE {NOTE_SEARCH_DOCUMENT} @@ q.query {keyset} ORDER BY score DESC, id LIMIT :limit'
+    ), params).all()
+    hits = [(hit.id, hit.score, hit.score) for hit in hits]
+    snippets = {}
+    if hits:
+        document = "concat_ws(' ', " + ', '.join(NOTE_FIELDS) + ")"
+        snippets = dict(db.session.execute(text(
+            f'WITH q AS (SELECT {tsquery} AS query) '
+            f"SELECT doctor_note.id, ts_headline('english', {document}, q.query, "
+            f"'StartSel=[, StopSel=], MaxWords=16, MinWords=5, MaxFragments=1') FROM doctor_note, q "
+            f"WHERE doctor_note.id IN (" + ', '.join(str(hit[0]) for hit in hits) + ")"
+        ), terms).all())
+    return hits, snippets
+
+NOTE_SEARCH_BACKENDS = {
+    'sqlite': search_notes_sqlite,
+    'postgresql': search_notes_postgres,
+}
+
+# Search cursors are "<score>_<id>" of the last result on the previous page
+def encode_search_cursor(score, note_id):
+    return f"{score!r}_{note_id}"
+
+def decode_search_cursor(cursor):
+    score, note_id = cursor.rsplit('_', 1)
+    return float(score), int(note_id)
+
+# AJAX route to search every patient's notes, best matches first (?q=, ?after=)
+@app.route('/api/notes/search', methods=['GET'])
+@login_required
+def search_notes():
+    search = NOTE_SEARCH_BACKENDS.get(db.engine.dialect.name)
+    if search is None:
+        return jsonify({'error': 'Note search needs SQLite or PostgreSQL.'}), 501
+    query = request.args.get('q', '')
+    if not note_search_query(query):
+        return jsonify({'error': 'Enter something to search for'}), 400
+    limit = page_size(app.config['NOTES_PAGE_SIZE'])
+    after = None
+    if request.args.get('after'):
+        try:
+            after = decode_search_cursor(request.args['after'])
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+
+    try:
+        hits, snippets = search(query, limit + 1, after)
+    except (ValueError, OperationalError):
+        db.session.rollback()
+        return jsonify({'error': 'Invalid search query'}), 400
+    next_cursor = None
+    if len(hits) > limit:
+        hits = hits[:limit]
+        next_cursor = encode_search_cursor(hits[-1][1], hits[-1][0])
+    ids = [hit[0] for hit in hits]
+
+    notes = {}
+    if ids:
+        rows = db.session.query(
+            DoctorNote.id,
+            DoctorNote.patient_id,
+            Patient.name,
+            DoctorNote.date,
+            *(getattr(DoctorNote, field) for field in NOTE_FIELDS)
+        ).join(Patient, Patient.id == DoctorNote.patient_id) \
+            .filter(DoctorNote.id.in_(ids)) \
+            .all()
+        notes = {row.id: row for row in rows}
+
+    results = []
+    for note_id, _, relevance in hits:
+        row = notes.get(note_id)
+        if row is None:
+            continue
+        result = {
+            'id': row.id,
+            'patient_id': row.patient_id,
+            'patient_name': row.name,
+            'date': row.date.strftime('%Y-%m-%d %H:%M'),
+            'score': relevance,
+            'snippet': snippets.get(note_id, ''),
+        }
+        for field in NOTE_FIELDS:
+            result[field] = getattr(row, field)
+        results.append(result)
+
+    return jsonify({'query': note_search_query(query), 'results': results, 'next_cursor': next_cursor})
+
 # Route to add a new patient
 @app.route('/add_patient', methods=['GET', 'POST'])
 @login_required
@@ -282,33 +889,22 @@ def add_doctor_note(patient_id):
             return redirect(request.url)
         
         if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-            filename = f"{current_user.username}_{timestamp}_{filename}"
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            file_path = new_upload_path(file.filename)
             file.save(file_path)
-            
-            # Pass the audio file path to the helper function to extract note data
-            note_data = run(file_path)
 
-            # Create and save the new doctor note
-            new_note = DoctorNote(
-                patient_id=patient.id,
-                subjective=note_data['subjective'],
-                objective=note_data['objective'],
-                assessment=note_data['assessment'],
-                plan=note_data['plan'],
-                intervention=note_data['intervention'],
-                other=note_data['other'],
-                date=datetime.utcnow()
-            )
-            db.session.add(new_note)
-            db.session.commit()
-            
-            # Optionally, delete the audio file after processing
-            os.remove(file_path)
-            
-            flash('Doctor note added successfully.', 'success')
+            # Hand the recording to the background workers; the note is saved when the job finishes
+            try:
+                job = note_jobs.submit(file_path=file_path, context={'patient_id': patient.id})
+            except QueueFull as e:
+                discard_upload(file_path)
+                if wants_json():
+                    return jsonify({'error': str(e)}), 503
+                flash(f'{e} Please try again in a few minutes.', 'danger')
+                return redirect(request.url)
+
+            if wants_json():
+                return jsonify(job.to_dict()), 202
+            flash('Audio uploaded. The note will appear once transcription finishes.', 'success')
             return redirect(url_for('index'))
         else:
             flash('Invalid file type. Allowed types are mp3, wav, ogg.', 'danger')
@@ -316,6 +912,197 @@ def add_doctor_note(patient_id):
     
     return render_template('upload_audio.html', patient=patient)
 
+# Route to add a doctor note from a raw audio request body (?filename= gives the type).
+# The body is decoded, split and transcribed while it is still uploading, so the first
+# chunks are transcribed before the upload finishes; categorization then runs as a job.
+# The body is also saved to UPLOAD_FOLDER as it arrives so the job can archive it.
+@app.route('/patient/<int:patient_id>/add_note/stream', methods=['POST'])
+@login_required
+def stream_doctor_note(patient_id):
+    patient = Patient.query.get_or_404(patient_id)
+    if not allowed_file(request.args.get('filename', '')):
+        return jsonify({'error': 'Invalid file type. Allowed types are mp3, wav, ogg.'}), 400
+
+    file_path = new_upload_path(request.args['filename'])
+    try:
+        with open(file_path, 'wb') as upload:
+            transcript = transcribe_stream(request.stream, copy_to=upload)
+    except RuntimeError:
+        discard_upload(file_path)
+        return jsonify({'error': 'The uploaded audio could not be decoded.'}), 400
+    except Exception:
+        discard_upload(file_path)
+        raise
+    if not transcript:
+        discard_upload(file_path)
+        return jsonify({'error': 'No speech could be transcribed from the recording.'}), 422
+
+    try:
+        job = note_jobs.submit(transcript=transcript, file_path=file_path, context={'patient_id': patient.id})
+    except QueueFull as e:
+        discard_upload(file_path)
+        return jsonify({'error': str(e)}), 503
+
+    flash('Audio uploaded. The note will appear once it has been categorized.', 'success')
+    return jsonify(job.to_dict()), 202
+
+# Page for dictating a note live from the microphone
+@app.route('/patient/<int:patient_id>/dictate', methods=['GET'])
+@login_required
+def dictate_note(patient_id):
+    patient = Patient.query.get_or_404(patient_id)
+    return render_template('dictate.html', patient=patient, sample_rate=STREAM_SAMPLE_RATE)
+
+# Route to start a live dictation. The client then POSTs 16-bit mono PCM frames
+# (at ?sample_rate=) to /dictation/<id>/audio, watches /dictation/<id>/events for
+# partial transcripts and POSTs /dictation/<id>/finish when the nurse stops talking.
+@app.route('/patient/<int:patient_id>/dictation', methods=['POST'])
+@login_required
+def start_dictation(patient_id):
+    patient = Patient.query.get_or_404(patient_id)
+    sample_rate = request.args.get('sample_rate', STREAM_SAMPLE_RATE, type=int)
+    if sample_rate % 1000 or not 8000 <= sample_rate <= 48000:
+        return jsonify({'error': 'sample_rate must be a multiple of 1000 between 8000 and 48000.'}), 400
+    try:
+        session = dictations.start(sample_rate, context={'patient_id': patient.id, 'user_id': current_user.id})
+    except TooManyDictations as e:
+        return jsonify({'error': str(e)}), 503
+    return jsonify(session.to_dict()), 201
+
+# Helper function to look up one of the current user's dictations
+def find_dictation(session_id):
+    session = dictations.get(session_id)
+    if session is None or session.context['user_id'] != current_user.id:
+        return None
+    return session
+
+# Route to send the next frames of a dictation; replies with the transcript so far
+@app.route('/dictation/<session_id>/audio', methods=['POST'])
+@login_required
+def dictation_audio(session_id):
+    session = find_dictation(session_id)
+    if session is None:
+        return jsonify({'error': 'Dictation not found'}), 404
+    try:
+        session.feed(request.get_data())
+    except DictationClosed as e:
+        return jsonify({'error': str(e)}), 409
+    return jsonify(session.to_dict())
+
+# Server-sent events with the state of a dictation every time a chunk is
+# transcribed; the stream ends with the saved note (or the error)
+@app.route('/dictation/<session_id>/events', methods=['GET'])
+@login_required
+def dictation_events(session_id):
+    session = find_dictation(session_id)
+    if session is None:
+        return jsonify({'error': 'Dictation not found'}), 404
+
+    def events():
+        version, state = None, session.to_dict()
+        while True:
+            if state is None:
+                yield ': keep-alive\n\n'
+            else:
+                event = {'finished': 'note', 'failed': 'failed', 'cancelled': 'failed'}.get(state['status'], 'transcript')
+                yield f"event: {event}\ndata: {json.dumps(state)}\n\n"
+                if state['status'] in FINAL_STATUSES:
+                    return
+            version, state = session.wait(version, timeout=DICTATION_KEEPALIVE)
+
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Route to end a dictation: the remaining audio is transcribed, the whole text
+# is categorized once and the note is saved. If categorizing fails the route
+# can be called again; it reuses the transcript instead of the audio.
+@app.route('/dictation/<session_id>/finish', methods=['POST'])
+@login_required
+def finish_dictation(session_id):
+    session = find_dictation(session_id)
+    if session is None:
+        return jsonify({'error': 'Dictation not found'}), 404
+    try:
+        transcript = session.finish()
+    except DictationClosed as e:
+        return jsonify({'error': str(e)}), 409
+    except Exception as e:
+        print(f"Dictation {session.id} could not be transcribed: {e}")
+        return jsonify(session.to_dict()), 502
+    if not transcript:
+        session.fail('No speech could be transcribed from the recording.')
+        return jsonify(session.to_dict()), 422
+
+    try:
+        note_data = categorize(transcript, cache=get_cache())
+    except Exception as e:
+        print(f"Dictation {session.id} could not be categorized: {e}")
+        session.fail('The note could not be categorized. Finish the dictation again to retry.')
+        return jsonify(session.to_dict()), 502
+    new_note = save_note(session.context['patient_id'], note_data)
+    session.complete(dict(note_data, note_id=new_note.id))
+    return jsonify(session.to_dict()), 201
+
+# Route to abandon a dictation without saving anything
+@app.route('/dictation/<session_id>', methods=['DELETE'])
+@login_required
+def cancel_dictation(session_id):
+    session = find_dictation(session_id)
+    if session is None:
+        return jsonify({'error': 'Dictation not found'}), 404
+    dictations.remove(session.id)
+    return jsonify(session.to_dict())
+
+# Route to poll the status of a transcription job
+@app.route('/jobs/<job_id>', methods=['GET'])
+@login_required
+def job_status(job_id):
+    job = note_jobs.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    status = job.to_dict()
+    status['queue_depth'] = note_jobs.queue_depth()
+    return jsonify(status)
+
+# Route to check how busy the transcription workers are
+@app.route('/jobs', methods=['GET'])
+@login_required
+def job_queue_status():
+    return jsonify({
+        'queue_depth': note_jobs.queue_depth(),
+        'running': note_jobs.running(),
+        'workers': note_jobs.workers,
+    })
+
+# Prometheus scrape endpoint: stage latencies, chunk/audio/token counts and
+# failures (no patient data, so it does not require a login)
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    metrics.JOB_QUEUE_DEPTH.set(note_jobs.queue_depth())
+    metrics.JOBS_RUNNING.set(note_jobs.running())
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# Route to play back (or download for reprocessing) the recording a note was
+# made from. Range requests are answered with 206 so players can seek without
+# fetching the whole file.
+@app.route('/notes/<int:note_id>/audio', methods=['GET'])
+@login_required
+def note_audio(note_id):
+    note = DoctorNote.query.get_or_404(note_id)
+    if not note.audio_digest or not audio_archive.exists(note.audio_digest):
+        return jsonify({'error': 'No recording is archived for this note'}), 404
+    response = send_file(
+        audio_archive.path(note.audio_digest),
+        mimetype=audio_archive.mimetype,
+        conditional=True,
+        etag=note.audio_digest,
+        max_age=app.config['AUDIO_ARCHIVE_MAX_AGE'],
+        download_name=f'note-{note.id}{audio_archive.extension}',
+    )
+    # patient audio may be cached by the browser but never by a shared proxy
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
 # Route to serve uploaded audio files (if needed)
 @app.route('/uploads/audio/<filename>')
 @login_required
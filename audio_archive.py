@@ -0,0 +1,78 @@
+# Long-term storage for the recordings notes were made from, so a note can be
+# listened to again or re-run through a better model later
+import os
+import re
+import subprocess
+import tempfile
+
+from pydub import AudioSegment
+
+import metrics
+from cache import file_digest
+
+DIGEST_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+class ArchiveError(Exception):
+    """Raised when a recording could not be transcoded into the archive."""
+
+
+class AudioArchive:
+    """Recordings stored once per distinct upload, transcoded to Opus.
+
+    A recording is addressed by the sha256 of the uploaded file (the key the
+    transcript cache uses too), so uploading the same file again costs
+    neither a transcode nor disk space. Files live at
+    <root>/<2 hex>/<2 hex>/<sha256>.opus so no directory grows past a few
+    thousand entries. 32 kbit/s Opus is a quarter of a 128 kbit/s mp3 and an
+    eighth of a 16 kHz 16-bit wav, and 16 kHz mono is all the speech
+    recognizers use.
+    """
+
+    extension = '.opus'
+    mimetype = 'audio/ogg'
+
+    def __init__(self, root, bitrate='32k', sample_rate=16000):
+        self.root = root
+        self.bitrate = bitrate
+        self.sample_rate = sample_rate
+
+    def path(self, digest):
+        if not DIGEST_PATTERN.match(digest):
+            raise ValueError(f'Not an archive digest: {digest!r}')
+        return os.path.join(self.root, digest[:2], digest[2:4], digest + self.extension)
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    # Archive the recording at `source_path` (any format ffmpeg reads) and return its digest
+    @metrics.span('archive_audio')
+    def store(self, source_path):
+        digest = file_digest(source_path)
+        path = self.path(digest)
+        if os.path.exists(path):
+            metrics.ARCHIVED_RECORDINGS.inc(outcome='duplicate')
+            return digest
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Transcode next to the final path and rename, so a crash or a
+        # concurrent store of the same upload never leaves a partial file behind
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=self.extension + '.tmp')
+        os.close(fd)
+        command = [AudioSegment.converter, '-loglevel', 'error', '-y', '-i', source_path,
+                   '-vn', '-ac', '1', '-ar', str(self.sample_rate),
+                   '-c:a', 'libopus', '-b:a', self.bitrate, '-application', 'voip',
+                   '-f', 'opus', temp_path]
+        try:
+            result = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.PIPE)
+            if result.returncode != 0:
+                error = result.stderr.decode('utf-8', 'replace').strip()
+                raise ArchiveError(f'ffmpeg could not transcode {source_path}: {error}')
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        metrics.ARCHIVED_RECORDINGS.inc(outcome='stored')
+        metrics.ARCHIVED_BYTES.inc(os.path.getsize(path))
+        return digest
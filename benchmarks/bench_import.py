@@ -0,0 +1,70 @@
+"""Benchmark import_data on a synthetic patients.json export.
+
+    python benchmarks/bench_import.py --patients 20000 --notes 5
+
+Imports the same file twice into a fresh SQLite database: once into the
+empty database and once more, where every note is a duplicate. Prints the
+results (including rows/sec) as JSON.
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+# Write a patients.json with the same shape as the bundled one
+def write_export(path, patients, notes_per_patient, seed=0):
+    rng = random.Random(seed)
+    with open(os.path.join(ROOT, 'patients.json'), encoding='utf-8') as f:
+        sample_notes = [note for patient in json.load(f) for note in patient['doctor_notes']]
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('[\n')
+        for patient_id in range(1, patients + 1):
+            notes = []
+            for i in range(notes_per_patient):
+                note = dict(rng.choice(sample_notes))
+                note['date'] = f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} {i % 24:02d}:{rng.randint(0, 59):02d}"
+                notes.append(note)
+            item = {'id': patient_id, 'name': f'Patient {patient_id}', 'age': rng.randint(1, 99), 'doctor_notes': notes}
+            f.write(json.dumps(item))
+            f.write(',\n' if patient_id < patients else '\n')
+        f.write(']\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--patients', type=int, default=5000)
+    parser.add_argument('--notes', type=int, default=5, help='notes per patient')
+    parser.add_argument('--batch-size', type=int, default=None)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_import_')
+    export_path = os.path.join(workdir, 'patients.json')
+    write_export(export_path, args.patients, args.notes)
+    # must be set before the app is imported
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    import app as nurse_app
+
+    results = {
+        'patients': args.patients,
+        'notes_per_patient': args.notes,
+        'export_bytes': os.path.getsize(export_path),
+        'runs': {},
+    }
+    # keep import_data's progress prints out of the JSON on stdout
+    with nurse_app.app.app_context(), contextlib.redirect_stdout(sys.stderr):
+        nurse_app.db.create_all()
+        for run_name in ('initial', 'reimport'):
+            kwargs = {'batch_size': args.batch_size} if args.batch_size else {}
+            results['runs'][run_name] = nurse_app.import_data(export_path, **kwargs)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
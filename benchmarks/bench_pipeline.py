@@ -0,0 +1,250 @@
+"""Benchmark the audio-to-note pipeline and the patient list/details routes offline.
+
+    python benchmarks/bench_pipeline.py --repeat 3 --patients 5000 --notes 20 --output results.json
+
+Audio: every bundled recording (MLK_Something_happening.mp3,
+16-122828-0002.wav, audio-chunks/*.wav) is decoded, split on silence,
+transcribed and run end to end through process_audio.run. The recognizer
+and the LLM are stubs (with optional simulated latency), so the numbers
+measure this code rather than the network. Each measurement is repeated
+--repeat times and the median kept.
+
+HTTP: a synthetic SQLite database with --patients patients and --notes
+notes each is queried through the Flask test client: the first page of
+/patients, paging through /api/patients, and /patient/<id>/details for
+random patients.
+
+Results, including peak RSS, are printed (or written to --output) as JSON
+so runs can be compared.
+"""
+import argparse
+import contextlib
+import glob
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+AUDIO_FILES = ['MLK_Something_happening.mp3', '16-122828-0002.wav'] + \
+    sorted(os.path.relpath(path, ROOT) for path in glob.glob(os.path.join(ROOT, 'audio-chunks', '*.wav')))
+
+# Text the stub recognizer returns for every chunk; it matches no
+# categorization rule, so every note goes through the (stub) LLM
+STUB_TEXT = 'the quick brown fox jumps over the lazy dog'
+
+
+# Peak resident set size of this process so far, in MB (ffmpeg's own memory is not included)
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def median_seconds(func, repeat):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings), result
+
+
+def make_stub_backend(latency):
+    from process_audio import SpeechBackend, TRANSCRIBE_MAX_WORKERS
+
+    class StubBackend(SpeechBackend):
+        max_workers = TRANSCRIBE_MAX_WORKERS
+
+        def transcribe_batch(self, chunks):
+            if latency:
+                time.sleep(latency)
+            return [STUB_TEXT for _ in chunks]
+
+    return StubBackend()
+
+
+# Anything with chat.completions.create works as the categorization client
+class StubLLM:
+    def __init__(self, latency):
+        self.latency = latency
+        self.chat = SimpleNamespace(completions=self)
+
+    def create(self, model, messages, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        transcript = messages[-1]['content'].rsplit('### ', 1)[-1]
+        reply = json.dumps({
+            'subjective': transcript, 'objective': '', 'assessment': '',
+            'plan': '', 'intervention': '', 'other': '',
+        })
+        usage = SimpleNamespace(prompt_tokens=len(messages[-1]['content']) // 4, completion_tokens=len(reply) // 4)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=reply))], usage=usage)
+
+
+def bench_audio(args):
+    import process_audio
+    from process_audio import (SilenceSegmenter, SPLIT_ON_SILENCE, STREAM_SAMPLE_RATE, STREAM_SAMPLE_WIDTH,
+                               get_large_audio_transcription_on_silence, run, stream_pcm)
+
+    backend = make_stub_backend(args.stt_latency / 1000)
+    client = StubLLM(args.llm_latency / 1000)
+    results = []
+    for name in AUDIO_FILES:
+        path = os.path.join(ROOT, name)
+        decode_seconds, pcm = median_seconds(lambda: b''.join(stream_pcm(path)), args.repeat)
+        audio_seconds = len(pcm) / (STREAM_SAMPLE_RATE * STREAM_SAMPLE_WIDTH)
+
+        def segment():
+            segmenter = SilenceSegmenter(**SPLIT_ON_SILENCE)
+            block = STREAM_SAMPLE_RATE * STREAM_SAMPLE_WIDTH * process_audio.STREAM_BLOCK_MS // 1000
+            chunks = []
+            for start in range(0, len(pcm), block):
+                chunks.extend(segmenter.feed(pcm[start:start + block]))
+            chunks.extend(segmenter.flush())
+            return len(chunks)
+        segment_seconds, chunks = median_seconds(segment, args.repeat)
+
+        transcribe_seconds, _ = median_seconds(
+            lambda: get_large_audio_transcription_on_silence(path, backend), args.repeat)
+        note_seconds, note = median_seconds(
+            lambda: run(path, backend=backend, client=client, cache=False), args.repeat)
+        results.append({
+            'file': name,
+            'audio_seconds': round(audio_seconds, 3),
+            'chunks': chunks,
+            'decode_seconds': decode_seconds,
+            'segment_seconds': segment_seconds,
+            'decode_realtime_factor': audio_seconds / decode_seconds if decode_seconds else None,
+            'transcribe_seconds': transcribe_seconds,
+            'chunks_per_second': chunks / transcribe_seconds if transcribe_seconds else None,
+            'note_seconds': note_seconds,
+            'notes_per_second': 1 / note_seconds if note_seconds and note else None,
+        })
+    return results
+
+
+# Fill the database with `patients` patients with `notes` notes each
+def build_database(nurse_app, patients, notes, seed=0):
+    from werkzeug.security import generate_password_hash
+    rng = random.Random(seed)
+    with open(os.path.join(ROOT, 'patients.json'), encoding='utf-8') as f:
+        sample_notes = [note for patient in json.load(f) for note in patient['doctor_notes']]
+    started = datetime(2024, 1, 1)
+    with nurse_app.app.app_context():
+        nurse_app.db.create_all()
+        session = nurse_app.db.session
+        session.add(nurse_app.User(username='bench', password_hash=generate_password_hash('bench')))
+        for first in range(1, patients + 1, 1000):
+            ids = range(first, min(first + 1000, patients + 1))
+            session.bulk_insert_mappings(nurse_app.Patient, [
+                {'id': patient_id, 'name': f'Patient {patient_id}', 'age': rng.randint(1, 99)} for patient_id in ids])
+            rows = []
+            for patient_id in ids:
+                for _ in range(notes):
+                    note = {field: value for field, value in rng.choice(sample_notes).items() if field != 'date'}
+                    note['patient_id'] = patient_id
+                    note['date'] = started + timedelta(minutes=rng.randint(0, 365 * 24 * 60))
+                    rows.append(note)
+            session.bulk_insert_mappings(nurse_app.DoctorNote, rows)
+            session.commit()
+
+
+def requests_per_second(client, paths):
+    started = time.perf_counter()
+    for path in paths:
+        response = client.get(path)
+        if response.status_code != 200:
+            raise RuntimeError(f'GET {path} returned {response.status_code}')
+    elapsed = time.perf_counter() - started
+    return {'requests': len(paths), 'seconds': elapsed, 'requests_per_second': len(paths) / elapsed}
+
+
+def bench_http(nurse_app, args):
+    started = time.perf_counter()
+    build_database(nurse_app, args.patients, args.notes)
+    build_seconds = time.perf_counter() - started
+
+    client = nurse_app.app.test_client()
+    client.post('/login', data={'username': 'bench', 'password': 'bench'})
+    rng = random.Random(1)
+
+    # walk the patient list a page at a time, as the sidebar does,
+    # starting over after the last page
+    list_paths = []
+    after = None
+    while len(list_paths) < args.requests:
+        path = '/api/patients' + (f'?after={after}' if after else '')
+        list_paths.append(path)
+        after = client.get(path).get_json()['next_cursor']
+    return {
+        'patients': args.patients,
+        'notes_per_patient': args.notes,
+        'build_seconds': build_seconds,
+        'index': requests_per_second(client, ['/patients'] * args.requests),
+        'api_patients': requests_per_second(client, list_paths),
+        'patient_details': requests_per_second(
+            client, [f'/patient/{rng.randint(1, args.patients)}/details' for _ in range(args.requests)]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=3, help='runs per audio measurement (the median is kept)')
+    parser.add_argument('--stt-latency', type=float, default=0, help='simulated recognizer latency per batch, in ms')
+    parser.add_argument('--llm-latency', type=float, default=0, help='simulated LLM latency per request, in ms')
+    parser.add_argument('--patients', type=int, default=2000)
+    parser.add_argument('--notes', type=int, default=10, help='notes per patient')
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--skip-audio', action='store_true')
+    parser.add_argument('--skip-http', action='store_true')
+    parser.add_argument('--output', help='write the results here instead of printing them')
+    args = parser.parse_args()
+
+    output_path = os.path.abspath(args.output) if args.output else None
+    workdir = tempfile.mkdtemp(prefix='bench_pipeline_')
+    # must be set before the app is imported; results are not cached between runs
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    os.environ['RESULT_CACHE'] = '0'
+    import app as nurse_app
+    # the templates live next to app.py unless they have been moved into templates/
+    if not os.path.isdir(os.path.join(ROOT, 'templates')):
+        nurse_app.app.template_folder = ROOT
+    # categorize() may dump replies relative to the working directory (CATEGORIZE_DUMP_DIR)
+    os.chdir(workdir)
+
+    results = {
+        'started_at': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'args': vars(args),
+    }
+    # keep the pipeline's progress prints out of the JSON on stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        if not args.skip_audio:
+            results['audio'] = bench_audio(args)
+            results['peak_rss_mb_after_audio'] = peak_rss_mb()
+        if not args.skip_http:
+            results['http'] = bench_http(nurse_app, args)
+    results['peak_rss_mb'] = peak_rss_mb()
+
+    output = json.dumps(results, indent=2)
+    if output_path:
+        with open(output_path, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Benchmark the rule-based SOAP classifier against the LLM's categorization.
+
+    python benchmarks/bench_soap_classifier.py --iterations 2000 [--llm 5]
+
+The reference notes are output.json (the LLM's answer for the sample
+dictation) and every note in patients.json. Each note is turned back into a
+transcript, classified locally, and scored by the share of sentences that
+land in the same field as the reference. Prints accuracy, confidence, how
+many notes would skip the LLM, and classify() latency as JSON. --llm N also
+times N categorize() calls that go to the LLM (needs OPENAI_API_KEY).
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import soap_classifier
+
+
+# (transcript, [(sentence, field), ...]) for every reference note
+def load_references():
+    with open(os.path.join(ROOT, 'output.json'), encoding='utf-8') as f:
+        notes = [('output.json', json.load(f))]
+    with open(os.path.join(ROOT, 'patients.json'), encoding='utf-8') as f:
+        for patient in json.load(f):
+            for note in patient['doctor_notes']:
+                notes.append((f"patient {patient['id']} {note['date']}", note))
+    references = []
+    for name, note in notes:
+        labelled = [(sentence, field) for field in soap_classifier.FIELDS
+                    for sentence in soap_classifier.split_sentences(note.get(field, ''))]
+        references.append((name, ' '.join(sentence for sentence, _ in labelled), labelled))
+    return references
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def time_calls(func, iterations):
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return {
+        'median_ms': statistics.median(timings) * 1000,
+        'p95_ms': percentile(timings, 0.95) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=1000, help='classify() calls timed per note')
+    parser.add_argument('--llm', type=int, default=0, help='also time this many LLM categorizations of the sample')
+    args = parser.parse_args()
+
+    references = load_references()
+    notes = []
+    correct = total = 0
+    for name, transcript, labelled in references:
+        _, confidence = soap_classifier.classify(transcript)
+        note_correct = sum(1 for sentence, field in labelled if soap_classifier.classify_sentence(sentence)[0] == field)
+        correct += note_correct
+        total += len(labelled)
+        notes.append({
+            'note': name,
+            'sentences': len(labelled),
+            'accuracy': note_correct / len(labelled),
+            'confidence': round(confidence, 3),
+            'fast_path': confidence >= soap_classifier.MIN_CONFIDENCE,
+            'latency': time_calls(lambda: soap_classifier.classify(transcript), args.iterations),
+        })
+
+    results = {
+        'min_confidence': soap_classifier.MIN_CONFIDENCE,
+        'sentence_accuracy': correct / total,
+        'fast_path_share': sum(note['fast_path'] for note in notes) / len(notes),
+        'median_classify_ms': statistics.median(note['latency']['median_ms'] for note in notes),
+        'notes': notes,
+    }
+    if args.llm:
+        from process_audio import categorize
+        sample = references[0][1]
+        # categorize() may dump replies (CATEGORIZE_DUMP_DIR=.) to the working
+        # directory, which in the repo root would overwrite the reference note
+        os.chdir(tempfile.mkdtemp(prefix='bench_soap_classifier_'))
+        results['llm_latency'] = time_calls(lambda: categorize(sample, fast_path=False), args.llm)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
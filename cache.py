@@ -0,0 +1,100 @@
+# Persistent cache for expensive pipeline results (transcripts, categorized notes)
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+# sha256 of a file's bytes, read in blocks
+def file_digest(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# sha256 of several strings, separated so ("ab", "c") != ("a", "bc")
+def text_digest(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """JSON values stored in SQLite under (namespace, key).
+
+    Entries older than `ttl` seconds are treated as missing, and once more
+    than `max_entries` are stored the least recently used ones are dropped.
+    The database file outlives the process, so results survive restarts.
+    """
+
+    def __init__(self, path, ttl=30 * 24 * 3600, max_entries=10000):
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS result_cache ('
+            ' namespace TEXT NOT NULL,'
+            ' key TEXT NOT NULL,'
+            ' value TEXT NOT NULL,'
+            ' created_at REAL NOT NULL,'
+            ' accessed_at REAL NOT NULL,'
+            ' PRIMARY KEY (namespace, key))'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS ix_result_cache_accessed_at ON result_cache (accessed_at)')
+
+    def get(self, namespace, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value, created_at FROM result_cache WHERE namespace = ? AND key = ?',
+                (namespace, key),
+            ).fetchone()
+            if row is None:
+                return None
+            if self.ttl is not None and now - row[1] > self.ttl:
+                self._conn.execute('DELETE FROM result_cache WHERE namespace = ? AND key = ?', (namespace, key))
+                return None
+            self._conn.execute(
+                'UPDATE result_cache SET accessed_at = ? WHERE namespace = ? AND key = ?',
+                (now, namespace, key),
+            )
+        return json.loads(row[0])
+
+    def set(self, namespace, key, value):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO result_cache (namespace, key, value, created_at, accessed_at)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                (namespace, key, json.dumps(value), now, now),
+            )
+            self._evict(now)
+
+    def _evict(self, now):
+        if self.ttl is not None:
+            self._conn.execute('DELETE FROM result_cache WHERE created_at < ?', (now - self.ttl,))
+        if self.max_entries is not None:
+            self._conn.execute(
+                'DELETE FROM result_cache WHERE rowid IN ('
+                ' SELECT rowid FROM result_cache ORDER BY accessed_at'
+                ' LIMIT max(0, (SELECT COUNT(*) FROM result_cache) - ?))',
+                (self.max_entries,),
+            )
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM result_cache')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
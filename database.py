@@ -0,0 +1,78 @@
+# Engine settings for the app's database. SQLite runs in WAL mode with a busy
+# timeout so note writes from several workers queue up instead of failing and
+# readers are never blocked by a writer; PostgreSQL gets a sized connection
+# pool that checks connections before handing them out.
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
+
+
+# Hosting providers still hand out postgres:// URLs, which SQLAlchemy no longer accepts
+def database_uri(uri):
+    if uri.startswith('postgres://'):
+        return 'postgresql://' + uri[len('postgres://'):]
+    return uri
+
+
+def is_sqlite(uri):
+    return make_url(uri).get_backend_name() == 'sqlite'
+
+
+# SQLALCHEMY_ENGINE_OPTIONS for the database in `config`
+def engine_options(config):
+    uri = config['SQLALCHEMY_DATABASE_URI']
+    if is_sqlite(uri):
+        # An in-memory database lives in a single connection, so there is no pool to size
+        if make_url(uri).database in (None, '', ':memory:'):
+            return {}
+        # Connections are cheap; the pool only bounds how many threads use the file at once
+        return {
+            'pool_size': config['DATABASE_POOL_SIZE'],
+            'max_overflow': config['DATABASE_MAX_OVERFLOW'],
+            'pool_timeout': config['DATABASE_POOL_TIMEOUT'],
+        }
+    return {
+        'pool_size': config['DATABASE_POOL_SIZE'],
+        'max_overflow': config['DATABASE_MAX_OVERFLOW'],
+        'pool_timeout': config['DATABASE_POOL_TIMEOUT'],
+        # Connections idle longer than this are replaced before the server or a proxy drops them
+        'pool_recycle': config['DATABASE_POOL_RECYCLE'],
+        # Test each connection on checkout so a restarted server costs a reconnect, not a 500
+        'pool_pre_ping': True,
+    }
+
+
+# Set the SQLite pragmas on every new connection of `engine`
+def configure_engine(engine, config):
+    if engine.dialect.name != 'sqlite':
+        return
+    pragmas = [
+        # Wait this many ms for another writer instead of failing with "database is locked"
+        f"PRAGMA busy_timeout = {int(config['SQLITE_BUSY_TIMEOUT'])}",
+        f"PRAGMA journal_mode = {config['SQLITE_JOURNAL_MODE']}",
+        # With WAL, NORMAL only syncs at checkpoints; a power cut can lose the
+        # last commits but never corrupts the database
+        f"PRAGMA synchronous = {config['SQLITE_SYNCHRONOUS']}",
+        # Page cache per connection, in KiB when negative
+        f"PRAGMA cache_size = -{int(config['SQLITE_CACHE_SIZE_KB'])}",
+        'PRAGMA temp_store = MEMORY',
+    ]
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in pragmas:
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
+
+
+# Move a PostgreSQL id sequence past the largest id in `table`, after rows
+# were inserted with explicit ids (SQLite needs nothing)
+def sync_id_sequence(connection, table):
+    if connection.dialect.name != 'postgresql':
+        return
+    connection.execute(text(
+        f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+        f"COALESCE((SELECT MAX(id) FROM {table}), 0) + 1, false)"
+    ))
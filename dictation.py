@@ -0,0 +1,207 @@
+# Live dictation: audio arrives in small frames while the nurse is still talking,
+# is split on silence and transcribed a chunk at a time, and the partial
+# transcript is published to whoever is watching the session
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from process_audio import SPLIT_ON_SILENCE, STREAM_SAMPLE_RATE, SilenceSegmenter, join_transcript, recognize_batch
+
+
+class TooManyDictations(Exception):
+    """Raised by DictationSessions.start when every session slot is taken."""
+
+
+class DictationClosed(Exception):
+    """Raised when audio is sent to a session that is no longer recording."""
+
+
+# Statuses after which a session never changes again
+FINAL_STATUSES = ('finished', 'failed', 'cancelled')
+
+
+class DictationSession:
+    """One dictation in progress.
+
+    feed() takes 16-bit mono PCM frames and returns as soon as any chunks the
+    segmenter split off have been handed to the executor; transcript() is the
+    text of the chunks transcribed so far. finish() flushes the last chunk and
+    waits for all of them, after which the caller categorizes the text and
+    calls complete() or fail(). If categorizing fails, finish() can be called
+    again and returns the same transcript without transcribing anything.
+    """
+
+    def __init__(self, backend, executor, sample_rate, context):
+        self.id = uuid.uuid4().hex
+        self.backend = backend
+        # extra data for the caller (e.g. patient_id), also shown in to_dict()
+        self.context = context
+        self.status = 'recording'
+        self.result = None
+        self.error = None
+        self.last_active = time.monotonic()
+        self._executor = executor
+        self._segmenter = SilenceSegmenter(sample_rate, **SPLIT_ON_SILENCE)
+        self._futures = []
+        # text of each chunk in order (None until it has been transcribed)
+        self._texts = []
+        # bumped on every change so watchers know there is something new
+        self._version = 0
+        self._changed = threading.Condition()
+        # feed() and finish() must see the audio in order
+        self._feed_lock = threading.Lock()
+        # set once every chunk has been transcribed
+        self._transcribed_all = False
+
+    def feed(self, data):
+        with self._feed_lock:
+            if self.status != 'recording':
+                raise DictationClosed('This dictation is no longer recording.')
+            self.last_active = time.monotonic()
+            for chunk in self._segmenter.feed(data):
+                self._submit(chunk)
+
+    def _submit(self, chunk):
+        with self._changed:
+            index = len(self._texts)
+            self._texts.append(None)
+            self._version += 1
+            self._changed.notify_all()
+        # one chunk per call: waiting to fill a batch would delay the partial transcript
+        future = self._executor.submit(recognize_batch, self.backend, [chunk])
+        self._futures.append(future)
+        future.add_done_callback(lambda future: self._transcribed(index, future))
+
+    def _transcribed(self, index, future):
+        with self._changed:
+            if future.exception() is None:
+                self._texts[index] = future.result()[0]
+            self._version += 1
+            self._changed.notify_all()
+
+    # text of the chunks transcribed so far, in the order they were spoken
+    def transcript(self):
+        with self._changed:
+            return join_transcript(text for text in self._texts if text)
+
+    # flush the audio after the last pause and wait for every chunk; returns the transcript
+    def finish(self):
+        with self._feed_lock:
+            if self.status == 'failed' and self._transcribed_all:
+                self._update(status='categorizing', error=None)
+                return self.transcript()
+            if self.status != 'recording':
+                raise DictationClosed('This dictation is no longer recording.')
+            self._update(status='transcribing')
+            for chunk in self._segmenter.flush():
+                self._submit(chunk)
+        try:
+            for future in self._futures:
+                future.result()
+        except Exception as e:
+            self.fail(str(e) or e.__class__.__name__)
+            raise
+        self._transcribed_all = True
+        metrics.NOTE_CHUNKS.observe(len(self._futures))
+        metrics.NOTE_AUDIO_SECONDS.observe(self._segmenter.duration_ms / 1000)
+        metrics.AUDIO_SECONDS_TOTAL.inc(self._segmenter.duration_ms / 1000)
+        self._update(status='categorizing')
+        return self.transcript()
+
+    def complete(self, result):
+        self._update(status='finished', result=result)
+
+    def fail(self, error):
+        self._update(status='failed', error=error)
+
+    def cancel(self):
+        with self._feed_lock:
+            if self.status not in FINAL_STATUSES:
+                self._update(status='cancelled')
+
+    def _update(self, **changes):
+        with self._changed:
+            for name, value in changes.items():
+                setattr(self, name, value)
+            self.last_active = time.monotonic()
+            self._version += 1
+            self._changed.notify_all()
+
+    # Block until the session changes after `version` (or `timeout` passes);
+    # returns the new version and to_dict(), or None for the state on a timeout
+    def wait(self, version, timeout=None):
+        with self._changed:
+            if not self._changed.wait_for(lambda: self._version != version, timeout):
+                return version, None
+            return self._version, self.to_dict()
+
+    def to_dict(self):
+        with self._changed:
+            data = {
+                'id': self.id,
+                'status': self.status,
+                'transcript': join_transcript(text for text in self._texts if text),
+                'chunks': len(self._texts),
+                'pending': sum(1 for text in self._texts if text is None),
+                'transcribed': self._transcribed_all,
+                'error': self.error,
+                'result': self.result,
+            }
+        data.update(self.context)
+        return data
+
+
+class DictationSessions:
+    """The dictation sessions of this process.
+
+    At most `max_sessions` exist at once; a session nobody has touched for
+    `idle_timeout` seconds is cancelled and forgotten. Chunks from every
+    session are transcribed on one shared pool of `workers` threads.
+
+    Sessions live in this process's memory, so every request for a session
+    has to reach the process that started it.
+    """
+
+    def __init__(self, get_backend, max_sessions=16, idle_timeout=300, workers=4):
+        self.get_backend = get_backend
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.workers = workers
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def start(self, sample_rate=STREAM_SAMPLE_RATE, context=None):
+        backend = self.get_backend()
+        with self._lock:
+            self._reap()
+            if len(self._sessions) >= self.max_sessions:
+                raise TooManyDictations('Too many dictations are in progress.')
+            # Threads are started lazily so importing the app does not spawn them
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='dictation')
+            session = DictationSession(backend, self._executor, sample_rate, dict(context or {}))
+            self._sessions[session.id] = session
+        return session
+
+    def get(self, session_id):
+        with self._lock:
+            self._reap()
+            return self._sessions.get(session_id)
+
+    def remove(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is not None:
+            session.cancel()
+        return session
+
+    def _reap(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        for session_id, session in list(self._sessions.items()):
+            # a session still finishing is waited on by its finish request
+            if session.last_active < cutoff and session.status not in ('transcribing', 'categorizing'):
+                del self._sessions[session_id]
+                session.cancel()
@@ -0,0 +1,183 @@
+# Background job queue used to keep slow audio processing off the request thread
+import queue
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime
+
+
+class QueueFull(Exception):
+    """Raised by JobQueue.submit when the pending queue is at capacity."""
+
+
+class PermanentJobError(Exception):
+    """Raise from a job function to fail the job without retrying it."""
+
+
+class RetryJob(Exception):
+    """Raise from a job function to retry it with some keyword arguments replaced.
+
+    Lets a retry start from work an earlier attempt already finished.
+    """
+
+    def __init__(self, message, **kwargs):
+        super().__init__(message)
+        self.kwargs = kwargs
+
+
+# A single unit of work and its current state
+class Job:
+    def __init__(self, args, kwargs, context):
+        self.id = uuid.uuid4().hex
+        self.args = args
+        self.kwargs = kwargs
+        # extra data for the callbacks (e.g. patient_id), also shown in to_dict()
+        self.context = context
+        self.status = 'queued'
+        self.attempts = 0
+        self.result = None
+        self.error = None
+        self.created_at = datetime.utcnow()
+        self.finished_at = None
+
+    def to_dict(self):
+        data = {
+            'id': self.id,
+            'status': self.status,
+            'attempts': self.attempts,
+            'error': self.error,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'finished_at': self.finished_at.strftime('%Y-%m-%d %H:%M:%S') if self.finished_at else None,
+        }
+        data.update(self.context)
+        return data
+
+
+class JobQueue:
+    """Runs `func(*args, **kwargs)` on a fixed pool of worker threads.
+
+    At most `workers` jobs run at once and at most `max_queue` wait; a failing
+    job is retried `max_retries` times with exponential backoff. `on_success`
+    and `on_failure` are called with the Job from the worker thread.
+
+    Jobs only exist in this process's memory: another process cannot see
+    them, and jobs still queued or running when the process exits are lost.
+    """
+
+    def __init__(self, func, workers=2, max_queue=32, max_retries=2, retry_delay=2.0,
+                 on_success=None, on_failure=None, keep_finished=1000):
+        self.func = func
+        self.workers = workers
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.on_success = on_success
+        self.on_failure = on_failure
+        self.keep_finished = keep_finished
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._jobs = {}
+        self._finished = []
+        self._lock = threading.Lock()
+        self._threads = []
+        self._running = 0
+
+    # Workers are started lazily so importing the app does not spawn threads
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f'job-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, *args, context=None, **kwargs):
+        self._start()
+        job = Job(args, kwargs, dict(context or {}))
+        with self._lock:
+            self._jobs[job.id] = job
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                del self._jobs[job.id]
+            raise QueueFull('Too many notes are waiting to be processed.')
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    # Number of jobs waiting for a free worker
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    # Number of jobs currently being processed
+    def running(self):
+        with self._lock:
+            return self._running
+
+    def join(self):
+        self._queue.join()
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                with self._lock:
+                    self._running += 1
+                try:
+                    self._run(job)
+                finally:
+                    with self._lock:
+                        self._running -= 1
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job):
+        while True:
+            job.status = 'running'
+            job.attempts += 1
+            try:
+                job.result = self.func(*job.args, **job.kwargs)
+            except Exception as e:
+                job.error = str(e) or e.__class__.__name__
+                traceback.print_exc()
+                if isinstance(e, PermanentJobError) or job.attempts > self.max_retries:
+                    self._finish(job, 'failed', self.on_failure)
+                    return
+                if isinstance(e, RetryJob):
+                    job.kwargs.update(e.kwargs)
+                job.status = 'retrying'
+                time.sleep(self.retry_delay * 2 ** (job.attempts - 1))
+            else:
+                job.error = None
+                self._finish(job, 'finished', self.on_success)
+                return
+
+    def _finish(self, job, status, callback):
+        if callback is not None:
+            try:
+                callback(job)
+            except Exception as e:
+                traceback.print_exc()
+                job.error = str(e) or e.__class__.__name__
+                status = 'failed'
+        job.status = status
+        job.finished_at = datetime.utcnow()
+        # forget the oldest finished jobs so the registry stays bounded
+        with self._lock:
+            self._finished.append(job.id)
+            while len(self._finished) > self.keep_finished:
+                self._jobs.pop(self._finished.pop(0), None)
+
+    def shutdown(self, wait=True):
+        threads = self._threads
+        for _ in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+        self._threads = []
@@ -0,0 +1,150 @@
+# In-process counters and histograms for the note pipeline, rendered in the
+# Prometheus text format by the /metrics route
+import threading
+import time
+from contextlib import contextmanager
+
+# seconds; wide enough for a single chunk as well as a whole recording
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """A named metric with one series per combination of `labelnames` values."""
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} needs the labels {", ".join(self.labelnames) or "(none)"}')
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            for key, value in sorted(self._series.items()):
+                lines.extend(self._render_series(key, value))
+        return lines
+
+    def _render_series(self, key, value):
+        return [f'{self.name}{_format_labels(key)} {_format_value(value)}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][i] += 1
+                    break
+            series['sum'] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _render_series(self, key, series):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, series['counts']):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{_format_labels(key, [("le", _format_value(bound))])} {cumulative}')
+        lines.append(f'{self.name}_sum{_format_labels(key)} {_format_value(series["sum"])}')
+        lines.append(f'{self.name}_count{_format_labels(key)} {cumulative}')
+        return lines
+
+
+# Every metric in Prometheus text format
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+STAGE_SECONDS = Histogram('note_stage_seconds', 'Time spent in each stage of turning a recording into a note.', ['stage'])
+STAGE_FAILURES = Counter('note_stage_failures_total', 'Stages that raised an exception.', ['stage'])
+NOTE_CHUNKS = Histogram('note_chunks', 'Silence-split chunks per transcribed recording.',
+                        buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+NOTE_AUDIO_SECONDS = Histogram('note_audio_seconds', 'Length of each transcribed recording.',
+                               buckets=(5, 15, 30, 60, 120, 300, 600, 1200, 3600))
+CHUNKS_TOTAL = Counter('transcribed_chunks_total', 'Chunks sent to the speech-to-text backend.', ['backend'])
+AUDIO_SECONDS_TOTAL = Counter('transcribed_audio_seconds_total', 'Seconds of audio decoded for transcription.')
+CATEGORIZATIONS = Counter('categorizations_total', 'Transcripts categorized, by where the result came from.', ['source'])
+LLM_REPAIRS = Counter('llm_repairs_total', 'Categorizations whose reply needed the repair prompt, by outcome.', ['outcome'])
+LLM_TOKENS = Counter('llm_tokens_total', 'Tokens used by categorization requests.', ['kind'])
+HTTP_REQUEST_SECONDS = Histogram('http_request_seconds', 'Time to handle each request.', ['endpoint', 'method', 'status'])
+JOB_QUEUE_DEPTH = Gauge('transcription_queue_depth', 'Transcription jobs waiting for a worker.')
+JOBS_RUNNING = Gauge('transcription_jobs_running', 'Transcription jobs being processed.')
+ARCHIVED_RECORDINGS = Counter('archived_recordings_total', 'Recordings sent to the audio archive, by whether they were new.', ['outcome'])
+ARCHIVED_BYTES = Counter('archived_bytes_total', 'Bytes of Opus written to the audio archive.')
+
+
+# Time one stage of the pipeline and count it as failed if it raises
+@contextmanager
+def span(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_FAILURES.inc(stage=stage)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage)
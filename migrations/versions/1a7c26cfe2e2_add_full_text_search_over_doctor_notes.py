@@ -0,0 +1,55 @@
+"""Add a full-text search index over doctor notes
+
+Revision ID: 1a7c26cfe2e2
+Revises: 80f6c0fd0051
+Create Date: 2026-10-18 11:58:12.318264
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1a7c26cfe2e2'
+down_revision = '80f6c0fd0051'
+branch_labels = None
+depends_on = None
+
+FIELDS = ('subjective', 'objective', 'assessment', 'plan', 'intervention', 'other')
+COLUMNS = ', '.join(FIELDS)
+NEW_VALUES = ', '.join('new.' + field for field in FIELDS)
+OLD_VALUES = ', '.join('old.' + field for field in FIELDS)
+
+
+def upgrade():
+    # FTS5 is SQLite only
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS doctor_note_fts USING fts5({COLUMNS}, "
+        f"content='doctor_note', content_rowid='id', tokenize='porter unicode61')"
+    )
+    op.execute(
+        f"CREATE TRIGGER IF NOT EXISTS doctor_note_fts_insert AFTER INSERT ON doctor_note BEGIN "
+        f"INSERT INTO doctor_note_fts(rowid, {COLUMNS}) VALUES (new.id, {NEW_VALUES}); END"
+    )
+    op.execute(
+        f"CREATE TRIGGER IF NOT EXISTS doctor_note_fts_delete AFTER DELETE ON doctor_note BEGIN "
+        f"INSERT INTO doctor_note_fts(doctor_note_fts, rowid, {COLUMNS}) VALUES ('delete', old.id, {OLD_VALUES}); END"
+    )
+    op.execute(
+        f"CREATE TRIGGER IF NOT EXISTS doctor_note_fts_update AFTER UPDATE ON doctor_note BEGIN "
+        f"INSERT INTO doctor_note_fts(doctor_note_fts, rowid, {COLUMNS}) VALUES ('delete', old.id, {OLD_VALUES}); "
+        f"INSERT INTO doctor_note_fts(rowid, {COLUMNS}) VALUES (new.id, {NEW_VALUES}); END"
+    )
+    # index the notes that already exist
+    op.execute("INSERT INTO doctor_note_fts(doctor_note_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute("DROP TRIGGER IF EXISTS doctor_note_fts_update")
+    op.execute("DROP TRIGGER IF EXISTS doctor_note_fts_delete")
+    op.execute("DROP TRIGGER IF EXISTS doctor_note_fts_insert")
+    op.execute("DROP TABLE IF EXISTS doctor_note_fts")
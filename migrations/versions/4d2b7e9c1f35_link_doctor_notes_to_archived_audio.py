@@ -0,0 +1,36 @@
+"""Link doctor notes to their archived audio
+
+Revision ID: 4d2b7e9c1f35
+Revises: 1a7c26cfe2e2
+Create Date: 2026-10-18 12:31:07.114825
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4d2b7e9c1f35'
+down_revision = '1a7c26cfe2e2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # initialize() creates new databases with db.create_all(), which already
+    # has the column and its index
+    columns = [column['name'] for column in sa.inspect(op.get_bind()).get_columns('doctor_note')]
+    with op.batch_alter_table('doctor_note', schema=None) as batch_op:
+        if 'audio_digest' not in columns:
+            batch_op.add_column(sa.Column('audio_digest', sa.String(length=64), nullable=True))
+        batch_op.create_index(batch_op.f('ix_doctor_note_audio_digest'), ['audio_digest'], unique=False, if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_doctor_note_audio_digest'), table_name='doctor_note', if_exists=True)
+    if op.get_bind().dialect.name == 'sqlite':
+        # batch mode would copy the table and lose the full-text index
+        # triggers on it; SQLite >= 3.35 drops the column in place
+        op.execute('ALTER TABLE doctor_note DROP COLUMN audio_digest')
+    else:
+        op.drop_column('doctor_note', 'audio_digest')
@@ -0,0 +1,33 @@
+"""Add a PostgreSQL full-text index over doctor notes
+
+Revision ID: b5e1c07d9a42
+Revises: 4d2b7e9c1f35
+Create Date: 2026-10-18 13:02:44.510733
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5e1c07d9a42'
+down_revision = '4d2b7e9c1f35'
+branch_labels = None
+depends_on = None
+
+FIELDS = ('subjective', 'objective', 'assessment', 'plan', 'intervention', 'other')
+# must match NOTE_SEARCH_DOCUMENT in app.py, or searches will not use the index
+DOCUMENT = "to_tsvector('english', " + " || ' ' || ".join(FIELDS) + ")"
+
+
+def upgrade():
+    # SQLite searches its FTS5 table instead (revision 1a7c26cfe2e2)
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute(f"CREATE INDEX IF NOT EXISTS ix_doctor_note_search ON doctor_note USING gin ({DOCUMENT})")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute("DROP INDEX IF EXISTS ix_doctor_note_search")
@@ -17,152 +17,801 @@
 # importing libraries 
 import speech_recognition as sr 
 import os 
+import collections
+import random
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pydub import AudioSegment
-from pydub.silence import split_on_silence
+import numpy as np
+import httpx
 import openai
 from openai import OpenAI
+import hashlib
 import json
 import json5
-
-def run(audio_path):
-    # create a speech recognition object
-    r = sr.Recognizer()
-
-    # a function to recognize speech in the audio file
-    # so that we don't repeat ourselves in in other functions
-    def transcribe_audio(path):
-        # use the audio file as the audio source
-        with sr.AudioFile(path) as source:
-            audio_listened = r.record(source)
-            # try converting it to text
-            text = r.recognize_google(audio_listened)
-        return text
-
-    # a function that splits the audio file into chunks on silence
-    # and applies speech recognition
-    def get_large_audio_transcription_on_silence(path):
-        """Splitting the large audio file into chunks
-        and apply speech recognition on each of these chunks"""
-        # open the audio file using pydub
-        sound = AudioSegment.from_file(path)  
-        # split audio sound where silence is 500 miliseconds or more and get chunks
-        chunks = split_on_silence(sound,
-            # experiment with this value for your target audio file
-            min_silence_len = 500,
-            # adjust this per requirement
-            silence_thresh = sound.dBFS-14,
-            # keep the silence for 1 second, adjustable as well
-            keep_silence=500,
-        )
-        folder_name = "audio-chunks"
-        # create a directory to store the audio chunks
-        if not os.path.isdir(folder_name):
-            os.mkdir(folder_name)
-        whole_text = ""
-        # process each chunk 
-        for i, audio_chunk in enumerate(chunks, start=1):
-            # export audio chunk and save it in
-            # the `folder_name` directory.
-            chunk_filename = os.path.join(folder_name, f"chunk{i}.wav")
-            audio_chunk.export(chunk_filename, format="wav")
-            # recognize the chunk
+import re
+from cache import ResultCache, file_digest, text_digest
+import soap_classifier
+import metrics
+
+# sample dictation used while tuning the categorization prompt
+SAMPLE_TRANSCRIPT = "Patient stated 'I feel short of breath' when the RN came in to check on them. Vitals signs showed BP 110/75 HR 100 RR 22 SPO2 89. Patient appeared fatigued and pale. May be suffering from asthma. This RN contacted the charge RN, rapid response nurse, and primary care physician. Oxygen was given to the patient via nasal cannula. SPO2 increased to 95, respiratory rate slowed to 18. The patient was transferred off of the med-surg unit and sent to the ICU due to unstable condition. Report given to ICU nurse who will continue to monitor the patient's condition. "
+
+# model used to split transcripts into note fields
+CATEGORIZE_MODEL = "gpt-3.5-turbo"
+# bump whenever the categorization prompt changes so cached results are not reused
+PROMPT_VERSION = 2
+# directory the last LLM reply is written to (output.txt/output.json) for
+# debugging; off unless set, since the replies contain patient data
+CATEGORIZE_DUMP_DIR = os.environ.get("CATEGORIZE_DUMP_DIR")
+# default OpenAI-compatible endpoint (point at a local mock server for
+# testing, or pass base_url to get_llm_client); None = api.openai.com
+LLM_BASE_URL = os.environ.get("OPENAI_BASE_URL")
+# connections kept open to the LLM API and shared by every request in this process
+LLM_MAX_CONNECTIONS = 20
+# transcripts categorized at once by categorize_many
+LLM_MAX_CONCURRENCY = 8
+LLM_TIMEOUT = 60.0
+# skip the LLM when the rule-based classifier is at least this sure ("SOAP_FAST_PATH=0" disables it)
+SOAP_FAST_PATH_ENABLED = os.environ.get("SOAP_FAST_PATH", "1") != "0"
+SOAP_FAST_PATH_MIN_CONFIDENCE = soap_classifier.MIN_CONFIDENCE
+
+# where transcripts and categorized notes are cached ("RESULT_CACHE=0" disables it)
+RESULT_CACHE_ENABLED = os.environ.get("RESULT_CACHE", "1") != "0"
+RESULT_CACHE_PATH = os.environ.get("RESULT_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "instance", "results_cache.db"))
+# entries expire after this many seconds; the least recently used go past the size limit
+RESULT_CACHE_TTL = 30 * 24 * 3600
+RESULT_CACHE_MAX_ENTRIES = 10000
+
+# how many chunks are sent to the recognizer at once (1 = one at a time)
+TRANSCRIBE_MAX_WORKERS = 4
+# retries when the recognizer rejects a request (e.g. rate limited)
+TRANSCRIBE_MAX_RETRIES = 3
+# base delay in seconds, doubled on every retry
+TRANSCRIBE_BACKOFF = 1.0
+
+# a function to recognize speech in an in-memory audio chunk
+# so that we don't repeat ourselves in in other functions
+def transcribe_audio(audio_data, r):
+    # try converting it to text
+    return r.recognize_google(audio_data)
+
+# transcribe one chunk, backing off when the service refuses the request
+def transcribe_chunk(audio_data, r, max_retries=TRANSCRIBE_MAX_RETRIES, backoff=TRANSCRIBE_BACKOFF):
+    for attempt in range(max_retries + 1):
+        try:
+            return transcribe_audio(audio_data, r)
+        except sr.UnknownValueError as e:
+            # nothing intelligible in this chunk
+            print("Error:", str(e))
+            return ""
+        except sr.RequestError as e:
+            if attempt == max_retries:
+                raise
+            delay = backoff * 2 ** attempt
+            print(f"Recognition request failed ({e}), retrying in {delay:.1f}s")
+            # jitter so parallel chunks don't retry in lockstep
+            time.sleep(delay + random.uniform(0, backoff))
+
+# which speech-to-text engine transcribes the chunks: "google" (network)
+# or "whisper" (local CPU model, needs the optional transformers + torch)
+STT_BACKEND = os.environ.get("STT_BACKEND", "google")
+# Hugging Face model id for the local engine
+WHISPER_MODEL = os.environ.get("WHISPER_MODEL", "openai/whisper-base.en")
+# chunks passed to the local model per inference call
+WHISPER_BATCH_SIZE = 8
+# Whisper hears 30 s at a time; the segmenter can emit chunks up to
+# SEGMENT_MAX_CHUNK_MS long, so longer chunks are cut into windows of
+# this many seconds (overlapping by a sixth) and the texts stitched back
+WHISPER_CHUNK_LENGTH_S = 30
+
+class SpeechBackend:
+    """Transcribes lists of sr.AudioData chunks.
+
+    `batch_size` chunks are handed to transcribe_batch() at a time, from up
+    to `max_workers` threads.
+    """
+    batch_size = 1
+    max_workers = 1
+
+    def transcribe_batch(self, chunks):
+        raise NotImplementedError
+
+    # identifies the engine in transcript cache keys
+    def cache_key(self):
+        return self.__class__.__name__
+
+# recognize_google, one network request per chunk
+class GoogleBackend(SpeechBackend):
+    max_workers = TRANSCRIBE_MAX_WORKERS
+
+    def __init__(self, recognizer=None):
+        self.recognizer = recognizer or sr.Recognizer()
+
+    def transcribe_batch(self, chunks):
+        return [transcribe_chunk(audio_chunk, self.recognizer) for audio_chunk in chunks]
+
+# Whisper running in-process on the CPU; the model is loaded once and
+# each call runs a whole batch of chunks through it
+class WhisperBackend(SpeechBackend):
+    batch_size = WHISPER_BATCH_SIZE
+
+    def __init__(self, model_name=WHISPER_MODEL, batch_size=WHISPER_BATCH_SIZE):
+        try:
+            from transformers import pipeline
+        except ImportError:
+            raise RuntimeError("The whisper backend needs the transformers and torch packages installed.")
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.pipeline = pipeline("automatic-speech-recognition", model=model_name, device="cpu",
+                                 chunk_length_s=WHISPER_CHUNK_LENGTH_S)
+        # the pipeline is not safe to call from several threads at once
+        self.lock = threading.Lock()
+
+    def transcribe_batch(self, chunks):
+        inputs = []
+        for audio_chunk in chunks:
+            samples = np.frombuffer(audio_chunk.get_raw_data(convert_width=2), dtype=np.int16)
+            inputs.append({"raw": samples.astype(np.float32) / 32768.0, "sampling_rate": audio_chunk.sample_rate})
+        with self.lock:
+            results = self.pipeline(inputs, batch_size=self.batch_size)
+        return [result["text"].strip() for result in results]
+
+    def cache_key(self):
+        return f"WhisperBackend:{self.model_name}"
+
+SPEECH_BACKENDS = {
+    "google": GoogleBackend,
+    "whisper": WhisperBackend,
+}
+
+_backends = {}
+_backends_lock = threading.Lock()
+_cache = None
+_llm_clients = {}
+
+# the shared backend for this process, created on first use so a local
+# model stays loaded across requests
+def get_backend(name=None):
+    name = name or STT_BACKEND
+    with _backends_lock:
+        if name not in _backends:
+            if name not in SPEECH_BACKENDS:
+                raise ValueError(f"Unknown speech-to-text backend {name!r}")
+            _backends[name] = SPEECH_BACKENDS[name]()
+        return _backends[name]
+
+# the shared OpenAI client for this process and `base_url` (LLM_BASE_URL
+# unless given); its connection pool keeps TLS connections alive between
+# notes instead of reconnecting every time
+def get_llm_client(base_url=None):
+    base_url = base_url or LLM_BASE_URL
+    with _backends_lock:
+        if base_url not in _llm_clients:
+            http_client = httpx.Client(
+                limits=httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_CONNECTIONS),
+                timeout=LLM_TIMEOUT,
+            )
+            _llm_clients[base_url] = OpenAI(
+                api_key=os.environ.get('OPENAI_API_KEY', ''),
+                base_url=base_url,
+                http_client=http_client,
+            )
+        return _llm_clients[base_url]
+
+# the shared result cache for this process (None when disabled)
+def get_cache():
+    global _cache
+    if not RESULT_CACHE_ENABLED:
+        return None
+    with _backends_lock:
+        if _cache is None:
+            _cache = ResultCache(RESULT_CACHE_PATH, ttl=RESULT_CACHE_TTL, max_entries=RESULT_CACHE_MAX_ENTRIES)
+        return _cache
+
+# PCM format the streaming decoder asks ffmpeg for
+STREAM_SAMPLE_RATE = 16000
+STREAM_SAMPLE_WIDTH = 2
+# how much decoded audio is read from ffmpeg at a time, in ms
+STREAM_BLOCK_MS = 1000
+# how much of ffmpeg's error output is kept for the decode error message
+STREAM_STDERR_TAIL_BYTES = 16 * 1024
+# longest chunk handed to the recognizer before it is cut without a pause, in ms
+SEGMENT_MAX_CHUNK_MS = 60000
+
+class SilenceSegmenter:
+    """Incremental split_on_silence for 16-bit mono PCM.
+
+    feed() takes PCM bytes as they are decoded and returns the chunks
+    (sr.AudioData) that are complete so far; flush() returns the rest once
+    the stream ends. Chunks match pydub's split_on_silence (seek_step=1):
+    a pause is a run of `min_silence_len` ms windows whose RMS is at or
+    below `silence_thresh` dBFS, and each chunk keeps up to `keep_silence`
+    ms of the pause on either side. Only the current chunk and the last
+    `min_silence_len + keep_silence` ms of pause are held in memory.
+
+    When `silence_thresh` is None the threshold follows the loudness of the
+    audio seen so far plus `silence_offset` (the streaming equivalent of
+    `sound.dBFS - 14`, which needs the whole recording).
+    """
+
+    def __init__(self, sample_rate=STREAM_SAMPLE_RATE, min_silence_len=500, silence_thresh=None,
+                 keep_silence=500, silence_offset=-14, max_chunk_len=SEGMENT_MAX_CHUNK_MS):
+        if sample_rate % 1000:
+            raise ValueError("sample_rate must be a whole number of samples per millisecond")
+        self.sample_rate = sample_rate
+        self.min_silence_len = min_silence_len
+        self.silence_thresh = silence_thresh
+        self.keep_silence = keep_silence
+        self.silence_offset = silence_offset
+        self.max_chunk_len = max_chunk_len
+        self._samples_per_ms = sample_rate // 1000
+        self._bytes_per_ms = self._samples_per_ms * STREAM_SAMPLE_WIDTH
+        # bytes that do not fill a whole ms yet
+        self._tail = b""
+        # PCM for ms [_pcm_start, _total_ms)
+        self._pcm = bytearray()
+        self._pcm_start = 0
+        self._total_ms = 0
+        # per-ms sum of squares for ms [_next_window, _total_ms)
+        self._energy = np.zeros(0)
+        self._next_window = 0
+        # running totals for the adaptive threshold
+        self._sum_sq = 0.0
+        self._n_samples = 0
+        # start of the open non-silent range (None while inside a pause)
+        self._ns_start = 0
+        # last silent window start
+        self._last_silent = None
+        # closed non-silent range (start, end) waiting for its chunk end
+        self._pending = None
+        # end of the last chunk; the next one never starts before it
+        self._floor = 0
+
+    # length of the audio fed so far
+    @property
+    def duration_ms(self):
+        return self._total_ms
+
+    # silence threshold as an RMS sample value
+    def _threshold(self):
+        if self.silence_thresh is None:
+            rms = np.sqrt(self._sum_sq / self._n_samples) if self._n_samples else 0.0
+            return rms * 10 ** (self.silence_offset / 20)
+        max_amp = float(1 << (8 * STREAM_SAMPLE_WIDTH - 1))
+        return max_amp * 10 ** (self.silence_thresh / 20)
+
+    def feed(self, data):
+        data = self._tail + bytes(data)
+        whole = len(data) - len(data) % self._bytes_per_ms
+        self._tail = data[whole:]
+        if not whole:
+            return []
+        samples = np.frombuffer(data[:whole], dtype=np.int16).astype(np.float64)
+        energy = np.square(samples).reshape(-1, self._samples_per_ms).sum(axis=1)
+        self._sum_sq += float(energy.sum())
+        self._n_samples += len(samples)
+        self._pcm += data[:whole]
+        self._total_ms += len(energy)
+        self._energy = np.concatenate((self._energy, energy))
+
+        chunks = []
+        # every window that now has min_silence_len ms of audio behind it
+        n_windows = self._total_ms - self.min_silence_len + 1 - self._next_window
+        if n_windows > 0:
+            cumulative = np.concatenate(([0.0], np.cumsum(self._energy)))
+            window_energy = cumulative[self.min_silence_len:] - cumulative[:-self.min_silence_len]
+            # integer RMS, like audioop.rms() in pydub's detect_silence
+            rms = np.floor(np.sqrt(window_energy / (self.min_silence_len * self._samples_per_ms)))
+            silent = rms <= self._threshold()
+            first = self._next_window
+            self._process_windows(first, np.flatnonzero(silent) + first, first + n_windows, chunks)
+            self._next_window += n_windows
+            self._energy = self._energy[n_windows:]
+        self._trim()
+        return chunks
+
+    def _process_windows(self, first, silent_starts, stop, chunks):
+        L = self.min_silence_len
+        for s in silent_starts:
+            s = int(s)
+            if self._last_silent is not None and s <= self._last_silent + L:
+                # close enough to the previous silent window to be the same pause
+                self._last_silent = s
+                continue
+            # the pause before this one ended at _last_silent + L
+            if self._ns_start is None:
+                self._open(self._last_silent + L, s, chunks)
+            self._cut_long_chunk(s, chunks)
+            self._close(s, chunks)
+            self._last_silent = s
+        # the current pause is over once its end window has been checked
+        if self._ns_start is None and self._last_silent + L < stop:
+            self._open(self._last_silent + L, stop, chunks)
+        if self._ns_start is not None:
+            self._cut_long_chunk(stop, chunks)
+        elif self._pending is not None:
+            # no overlap with the next chunk is possible any more
+            start, end = self._pending
+            if self._last_silent + L - self.keep_silence >= end + self.keep_silence:
+                self._emit(start, end + self.keep_silence, chunks)
+                self._pending = None
+
+    # a non-silent range starts at `start`; `until` is the next window to check
+    def _open(self, start, until, chunks):
+        self._ns_start = start
+        if self._pending is not None:
+            pending_start, pending_end = self._pending
+            end = pending_end + self.keep_silence
+            next_start = start - self.keep_silence
+            if next_start < end:
+                end = (end + next_start) // 2
+            self._emit(pending_start, end, chunks)
+            self._pending = None
+
+    # the open non-silent range ends at `end`
+    def _close(self, end, chunks):
+        if end > self._ns_start:
+            self._pending = (max(self._ns_start - self.keep_silence, self._floor, 0), end)
+        self._ns_start = None
+
+    # split speech with no pause for max_chunk_len ms
+    def _cut_long_chunk(self, now, chunks):
+        if not self.max_chunk_len:
+            return
+        start = max(self._ns_start - self.keep_silence, self._floor, 0)
+        # leave room for the padding added when the range closes
+        while now + self.keep_silence - start > self.max_chunk_len:
+            self._emit(start, start + self.max_chunk_len, chunks)
+            start = self._ns_start = self._floor
+
+    def _emit(self, start, end, chunks):
+        end = min(end, self._total_ms)
+        if end > start:
+            frames = bytes(self._pcm[(start - self._pcm_start) * self._bytes_per_ms:(end - self._pcm_start) * self._bytes_per_ms])
+            chunks.append(sr.AudioData(frames, self.sample_rate, STREAM_SAMPLE_WIDTH))
+        self._floor = max(self._floor, end)
+
+    # drop PCM that no future chunk can include
+    def _trim(self):
+        if self._pending is not None:
+            keep_from = self._pending[0]
+        elif self._ns_start is not None:
+            keep_from = max(self._ns_start - self.keep_silence, self._floor)
+        else:
+            keep_from = max(self._last_silent + self.min_silence_len - self.keep_silence, self._floor)
+        keep_from = min(max(keep_from, 0), self._total_ms)
+        if keep_from > self._pcm_start:
+            del self._pcm[:(keep_from - self._pcm_start) * self._bytes_per_ms]
+            self._pcm_start = keep_from
+
+    def flush(self):
+        chunks = []
+        total = self._total_ms
+        if self._ns_start is None and self._last_silent + self.min_silence_len < total:
+            self._open(self._last_silent + self.min_silence_len, total, chunks)
+        if self._ns_start is not None:
+            self._cut_long_chunk(total, chunks)
+            self._close(total, chunks)
+        if self._pending is not None:
+            start, end = self._pending
+            self._emit(start, end + self.keep_silence, chunks)
+            self._pending = None
+        self._pcm = bytearray()
+        self._pcm_start = total
+        return chunks
+
+# a file-like wrapper that hashes everything read through it, so a
+# streamed upload gets the same cache key as the saved file would; with
+# `copy_to` (a binary file) the bytes are also saved as they go by
+class HashingReader:
+    def __init__(self, stream, copy_to=None):
+        self.stream = stream
+        self.copy_to = copy_to
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.digest.update(data)
+        if self.copy_to is not None:
+            self.copy_to.write(data)
+        return data
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+# decode any format ffmpeg understands into 16-bit mono PCM and yield it
+# in STREAM_BLOCK_MS blocks, without ever holding the whole recording;
+# `source` is a file path or a readable binary stream (e.g. an upload
+# still arriving), which is piped into ffmpeg from a background thread
+def stream_pcm(source, sample_rate=STREAM_SAMPLE_RATE):
+    piped = not isinstance(source, (str, os.PathLike))
+    command = [AudioSegment.converter, "-loglevel", "error", "-i", "pipe:0" if piped else source,
+               "-f", "s16le", "-acodec", "pcm_s16le", "-ac", "1", "-ar", str(sample_rate), "-"]
+    if not piped:
+        command.insert(1, "-nostdin")
+    block_size = sample_rate * STREAM_SAMPLE_WIDTH * STREAM_BLOCK_MS // 1000
+    process = subprocess.Popen(command, stdin=subprocess.PIPE if piped else subprocess.DEVNULL,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # ffmpeg can write more errors than the pipe holds (a long, damaged
+    # file), so stderr is drained while decoding and only its tail is kept
+    stderr_tail = bytearray()
+    def read_errors():
+        for data in iter(lambda: process.stderr.read(4096), b""):
+            stderr_tail.extend(data)
+            del stderr_tail[:-STREAM_STDERR_TAIL_BYTES]
+    error_reader = threading.Thread(target=read_errors, daemon=True)
+    error_reader.start()
+    writer = None
+    writer_errors = []
+    if piped:
+        def write_input():
             try:
-                text = transcribe_audio(chunk_filename)
-            except sr.UnknownValueError as e:
-                print("Error:", str(e))
-            else:
-                text = f"{text.capitalize()}. "
-                # print(chunk_filename, ":", text)
-                whole_text += text
-        # return the text for all chunks detected
-        return whole_text
-
-    def reformat_to_json5(string):
+                while True:
+                    data = source.read(64 * 1024)
+                    if not data:
+                        break
+                    process.stdin.write(data)
+            except BrokenPipeError:
+                # ffmpeg exited early; its exit status reports why
+                pass
+            except Exception as e:
+                writer_errors.append(e)
+                process.kill()
+            finally:
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+        writer = threading.Thread(target=write_input, daemon=True)
+        writer.start()
+    try:
+        while True:
+            block = process.stdout.read(block_size)
+            if not block:
+                break
+            yield block
+        if writer is not None:
+            writer.join()
+            if writer_errors:
+                raise writer_errors[0]
+        if process.wait() != 0:
+            error_reader.join()
+            name = "uploaded audio" if piped else source
+            raise RuntimeError(f"Decoding {name} failed: {stderr_tail.decode(errors='replace').strip()}")
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        if writer is not None:
+            writer.join()
+        error_reader.join()
+        process.stdout.close()
+        process.stderr.close()
+
+# split_on_silence settings shared by file transcription and live dictation
+SPLIT_ON_SILENCE = dict(
+    # experiment with this value for your target audio file
+    min_silence_len = 500,
+    # adjust this per requirement (None = 14 dB below the average loudness)
+    silence_thresh = None,
+    # keep the silence for 1 second, adjustable as well
+    keep_silence = 500,
+)
+
+# yield the silence-split chunks of an audio file (or stream) as they are decoded
+def stream_audio_chunks(source, min_silence_len=500, silence_thresh=None, keep_silence=500):
+    segmenter = SilenceSegmenter(min_silence_len=min_silence_len, silence_thresh=silence_thresh,
+                                 keep_silence=keep_silence)
+    # decoding and splitting take turns, so the time spent waiting on ffmpeg
+    # (or on the upload feeding it) and splitting is added up and recorded
+    # once per recording
+    decode_seconds = segment_seconds = 0.0
+    blocks = stream_pcm(source)
+    while True:
+        started = time.perf_counter()
         try:
-            return json5.loads(string)
-        except json5.JSONDecodeError as e:
-            print(f"Error decoding JSON: {e}")
-            return None
-
-    # print(get_large_audio_transcription_on_silence("MLK_Something_happening.mp3"))
-
-    # TODO: The 'openai.my_api_key' option isn't read in the client API. You will need to pass it when you instantiate the client, e.g. 'OpenAI(my_api_key="")'
-
-    os.environ['OPENAI_API_KEY'] = ''
+            block = next(blocks, None)
+        except Exception:
+            metrics.STAGE_FAILURES.inc(stage="decode")
+            raise
+        decode_seconds += time.perf_counter() - started
+        if block is None:
+            break
+        started = time.perf_counter()
+        chunks = segmenter.feed(block)
+        segment_seconds += time.perf_counter() - started
+        yield from chunks
+    yield from segmenter.flush()
+    metrics.STAGE_SECONDS.observe(decode_seconds, stage="decode")
+    metrics.STAGE_SECONDS.observe(segment_seconds, stage="segment")
+    metrics.NOTE_AUDIO_SECONDS.observe(segmenter.duration_ms / 1000)
+    metrics.AUDIO_SECONDS_TOTAL.inc(segmenter.duration_ms / 1000)
+
+# transcribe one batch of chunks, timed as the "recognize" stage
+@metrics.span("recognize")
+def recognize_batch(backend, chunks):
+    metrics.CHUNKS_TOTAL.inc(len(chunks), backend=backend.cache_key())
+    return backend.transcribe_batch(chunks)
+
+# a function that splits the audio file into chunks on silence
+# and applies speech recognition
+@metrics.span("transcribe")
+def get_large_audio_transcription_on_silence(source, backend, max_workers=None):
+    """Splitting the large audio file into chunks
+    and apply speech recognition on each of these chunks"""
+    # decode the file (or upload stream) a block at a time and split it where
+    # silence is 500 miliseconds or more; chunks arrive while decoding continues
+    chunks = stream_audio_chunks(source, **SPLIT_ON_SILENCE)
+    # recognize the chunks in batches of backend.batch_size, up to `max_workers`
+    # batches in flight, starting on each batch as soon as it is split off.
+    # When recognition falls behind, decoding waits for the oldest batch once
+    # twice that many are queued, so only a bounded number of chunks is ever
+    # held in memory however long the recording is
+    max_workers = max(1, max_workers or backend.max_workers)
+    max_pending = 2 * max_workers
+    texts = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = collections.deque()
+        batch = []
+        for audio_chunk in chunks:
+            batch.append(audio_chunk)
+            if len(batch) == backend.batch_size:
+                pending.append(executor.submit(recognize_batch, backend, batch))
+                batch = []
+                if len(pending) >= max_pending:
+                    texts.extend(pending.popleft().result())
+        if batch:
+            pending.append(executor.submit(recognize_batch, backend, batch))
+        while pending:
+            texts.extend(pending.popleft().result())
+    metrics.NOTE_CHUNKS.observe(len(texts))
+    # return the text for all chunks detected
+    return join_transcript(texts)
+
+# join the text of each chunk into one transcript, a sentence per chunk
+def join_transcript(texts):
+    whole_text = ""
+    for text in texts:
+        if text:
+            whole_text += f"{text.capitalize()}. "
+    return whole_text
+
+# transcribe a recording, reusing the transcript of identical audio
+def transcribe_file(audio_path, backend, cache=None):
+    key = None
+    if cache is not None:
+        # the same audio can transcribe differently on another engine
+        key = f"{backend.cache_key()}:{file_digest(audio_path)}"
+        transcript = cache.get("transcript", key)
+        if transcript is not None:
+            return transcript
+    transcript = get_large_audio_transcription_on_silence(audio_path, backend)
+    if cache is not None:
+        cache.set("transcript", key, transcript)
+    return transcript
+
+# transcribe audio from a stream while it is still arriving: chunks are sent
+# to the recognizer as soon as a pause is found, so transcription overlaps
+# the upload; the transcript is cached under the hash of the streamed bytes.
+# `copy_to` keeps the recording, e.g. for the audio archive
+def transcribe_stream(stream, backend=None, cache=None, copy_to=None):
+    if backend is None:
+        backend = get_backend()
+    if cache is None:
+        cache = get_cache()
+    elif cache is False:
+        cache = None
+    reader = HashingReader(stream, copy_to)
+    transcript = get_large_audio_transcription_on_silence(reader, backend)
+    if cache is not None:
+        cache.set("transcript", f"{backend.cache_key()}:{reader.hexdigest()}", transcript)
+    return transcript
+
+# note fields the LLM must return, each a string
+NOTE_FIELDS = soap_classifier.FIELDS
+
+# raised when the LLM's reply cannot be turned into note fields, even after
+# the repair request, or by categorize_transcript() when the LLM request
+# itself fails; keeps the transcript so a retry starts from the text
+class CategorizationError(ValueError):
+    def __init__(self, message, transcript):
+        super().__init__(message)
+        self.transcript = transcript
+
+# json5 also accepts the near-JSON models sometimes produce (trailing
+# commas, single quotes, comments)
+def reformat_to_json5(string):
+    try:
+        return json5.loads(string)
+    except ValueError as e:
+        print(f"Error decoding JSON: {e}")
+        return None
+
+_MISSING = object()
+
+# check a reply against the note schema: an object with a string for every
+# field ("other" may be left out, null counts as empty); returns the note
+# fields and an empty list, or None and the problems found
+def parse_note(reply):
+    text = (reply or "").strip()
+    # models sometimes wrap the object in a ```json fence
+    fence = re.match(r"^```(?:json)?\s*(.*?)\s*```$", text, re.DOTALL)
+    if fence:
+        text = fence.group(1)
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end < start:
+        return None, ["the reply does not contain a JSON object"]
+    data = reformat_to_json5(text[start:end + 1])
+    if not isinstance(data, dict):
+        return None, ["the reply is not a valid JSON object"]
+
+    values = {str(key).strip().lower(): value for key, value in data.items()}
+    note = {}
+    problems = []
+    for field in NOTE_FIELDS:
+        value = values.get(field, "" if field == "other" else _MISSING)
+        if value is None:
+            value = ""
+        elif isinstance(value, list) and all(isinstance(item, str) for item in value):
+            value = " ".join(value)
+        if value is _MISSING:
+            problems.append(f'the "{field}" key is missing')
+        elif not isinstance(value, str):
+            problems.append(f'"{field}" must be a string')
+        else:
+            note[field] = value.strip()
+    unexpected = sorted(set(values) - set(NOTE_FIELDS))
+    if unexpected:
+        problems.append("unexpected keys: " + ", ".join(unexpected))
+    if problems:
+        return None, problems
+    return note, []
+
+# one chat completion in JSON mode; returns the reply text
+@metrics.span("llm_request")
+def request_note(client, messages):
+    response = client.chat.completions.create(model=CATEGORIZE_MODEL,
+    messages=messages, response_format={"type": "json_object"})
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        metrics.LLM_TOKENS.inc(usage.prompt_tokens, kind="prompt")
+        metrics.LLM_TOKENS.inc(usage.completion_tokens, kind="completion")
+    return response.choices[0].message.content
+
+_dump_lock = threading.Lock()
+
+# write a debug copy of an LLM reply to CATEGORIZE_DUMP_DIR (when set);
+# categorize runs on several threads, so one reply is written at a time
+def dump_reply(name, text):
+    if not CATEGORIZE_DUMP_DIR:
+        return
+    with _dump_lock:
+        os.makedirs(CATEGORIZE_DUMP_DIR, exist_ok=True)
+        with open(os.path.join(CATEGORIZE_DUMP_DIR, name), 'w') as file:
+            file.write(text)
+
+# split a transcript into the note fields, reusing earlier results for
+# the same transcript, prompt and model; formulaic dictation the local
+# classifier is sure about never reaches the LLM
+@metrics.span("categorize")
+def categorize(message, client=None, cache=None, fast_path=SOAP_FAST_PATH_ENABLED):
+    if fast_path:
+        with metrics.span("categorize_local"):
+            json_object, confidence = soap_classifier.classify(message)
+        if confidence >= SOAP_FAST_PATH_MIN_CONFIDENCE:
+            print(f"Categorized locally (confidence {confidence:.2f})")
+            metrics.CATEGORIZATIONS.inc(source="local")
+            return json_object
+
+    key = None
+    if cache is not None:
+        key = text_digest(message, PROMPT_VERSION, CATEGORIZE_MODEL)
+        json_object = cache.get("categorized", key)
+        if json_object is not None:
+            metrics.CATEGORIZATIONS.inc(source="cache")
+            return json_object
 
-    client = OpenAI(
-    api_key=os.environ['OPENAI_API_KEY'],  # this is also the default, it can be omitted
-    )
+    if client is None:
+        client = get_llm_client()
 
     # Initialize the system message
-    messages = [{"role": "system", "content": "You are an intelligent assistant."}]
-
-    # Assume `get_large_audio_transcription_on_silence` is a function that processes the audio file
-    # message = get_large_audio_transcription_on_silence(audio_path)
-
-    message = "Patient stated 'I feel short of breath' when the RN came in to check on them. Vitals signs showed BP 110/75 HR 100 RR 22 SPO2 89. Patient appeared fatigued and pale. May be suffering from asthma. This RN contacted the charge RN, rapid response nurse, and primary care physician. Oxygen was given to the patient via nasal cannula. SPO2 increased to 95, respiratory rate slowed to 18. The patient was transferred off of the med-surg unit and sent to the ICU due to unstable condition. Report given to ICU nurse who will continue to monitor the patient's condition. "
-
-                #    "These categories include subjective (medial history told by patients or their friends), "
-                #    "objective (numerical data observed during visit), "
-                #    "assessment (medical concern or concerns by nurse), "
-                #    "plan (diagnosis and care plan, including any prescriptions, self-care, follow-ups, or referrals if applicable), "
-                #    "intervention (what nurse did to the patient if anything, how well the intervention worked, and what changes are needed if any). "
+    messages = [{"role": "system", "content": "You are an intelligent assistant that replies with JSON."}]
+
+    # Update the message with the transcription
+    prompt = ("The text after the ### symbols is an audio transciption of a nurse reading patient notes. "
+                "Parse this text into 5 categories, including: "
+            "subjective (medical history, background, and patient words), "
+            "objective (measurable and qualitative info), "
+            "assessment (predictions about patient health issue), "
+            "plan (treatment plan for patient), "
+            "intervention (actions taken if any and what happened as a result). "
+            "All text must be in a category. Content is grouped together and given in the order the categories were given. "
+                "Categories should be empty if the text fits other categories better. "
+                "Only add text directly coming from the audio transcription. ALL text from audio transcription MUST be in a category. "
+                "Reply with a JSON object with exactly these string keys: subjective, objective, assessment, plan, intervention, other. "
+                "Put any text that fits none of the 5 categories in other. ### "
+            + message)
+
+    # Append the user message to the conversation history
+    messages.append({"role": "user", "content": prompt})
+
+    reply = request_note(client, messages)
+    print(f"ChatGPT: {reply}")
+
+    dump_reply('output.txt', reply or "")
+
+    json_object, problems = parse_note(reply)
+    if problems:
+        # ask only for the broken reply to be fixed rather than categorizing
+        # the transcript again
+        print(f"Repairing categorization: {'; '.join(problems)}")
+        repair = ("The JSON after the ### symbols should be an object with exactly these string keys: "
+                  + ", ".join(NOTE_FIELDS) + ". It has these problems: " + "; ".join(problems) + ". "
+                  "Reply with the corrected JSON object only, keeping the text of every category unchanged. ### "
+                  + (reply or ""))
+        reply = request_note(client, [messages[0], {"role": "user", "content": repair}])
+        print(f"ChatGPT (repair): {reply}")
+        json_object, problems = parse_note(reply)
+        metrics.LLM_REPAIRS.inc(outcome="failed" if problems else "fixed")
+        if problems:
+            raise CategorizationError("The categorized note is invalid: " + "; ".join(problems), message)
+
+    dump_reply('output.json', json.dumps(json_object, indent=4))
+
+    if cache is not None:
+        cache.set("categorized", key, json_object)
+    metrics.CATEGORIZATIONS.inc(source="llm")
+    return json_object
+
+# categorize, turning any failure (a timeout, rate limit or server error
+# as well as an unusable reply) into a CategorizationError that keeps the
+# transcript, with the original error as its __cause__
+def categorize_transcript(message, client=None, cache=None):
+    try:
+        return categorize(message, client, cache)
+    except CategorizationError:
+        raise
+    except Exception as e:
+        raise CategorizationError(f"Categorizing the transcript failed: {e}", message) from e
+
+# categorize many transcripts (e.g. the end-of-shift backlog), up to
+# `max_workers` completions in flight over the shared client. Results come
+# back in input order, one per transcript: the note fields, or the
+# CategorizationError for a transcript that failed, so one bad reply does
+# not cost the rest of the backlog. Repeated transcripts are only sent once
+def categorize_many(transcripts, client=None, cache=None, max_workers=LLM_MAX_CONCURRENCY):
+    if client is None:
+        client = get_llm_client()
+    unique = list(dict.fromkeys(transcripts))
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {transcript: executor.submit(categorize_transcript, transcript, client, cache)
+                   for transcript in unique}
+    results = {}
+    for transcript, future in futures.items():
+        error = future.exception()
+        results[transcript] = error if error is not None else future.result()
+    return [results[transcript] for transcript in transcripts]
+
+# `recognizer`, `backend`, `client` and `cache` can be swapped for in-process
+# stand-ins (anything with recognize_google, a SpeechBackend, anything with
+# chat.completions.create, a ResultCache); pass cache=False to skip caching
+def run(audio_path, recognizer=None, client=None, backend=None, cache=None):
+    # pick the speech-to-text engine (STT_BACKEND unless one is given)
+    if backend is None:
+        backend = GoogleBackend(recognizer) if recognizer is not None else get_backend()
+    if cache is None:
+        cache = get_cache()
+    elif cache is False:
+        cache = None
+
+    # print(get_large_audio_transcription_on_silence("MLK_Something_happening.mp3", backend))
+
+    # transcribe the uploaded recording
+    message = transcribe_file(audio_path, backend, cache)
 
     if message:
-        # Update the message with the transcription
-        message = ("The text after the ### symbols is an audio transciption of a nurse reading patient notes. "
-                #    "Using this text content, create a properly formatted .json file with 5 string variables. "
-                    "Parse this text into 5 categories, including: "
-                "subjective (medical history, background, and patient words), "
-                "objective (measurable and qualitative info), "
-                "assessment (predictions about patient health issue), "
-                "plan (treatment plan for patient), "
-                "intervention (actions taken if any and what happened as a result). "
-                #    "Feel free to split the content in sentences into different categories. "
-                "All text must be in a category. Content is grouped together and given in the order the categories were given. "
-                "Output text using each of these categories as one line. "
-                    "Categories should be empty if the text fits other categories better. Only write the text content for each line, do not label each line. "
-                    "Any text after the fifth line should be recategorized and placed in the correct line."
-                    "Print in this order: subjective, objective, assessment, plan, intervention. Only add text directly coming from the audio transcription. ALL text from audio transcription MUST be in a line. Must make EXACTLY 5 lines of output. Print ALL text uncategorized on the 6th line. ### "
-                    # "Do not output any extraneous text other than the .json file text. The output should start with { and end with }.  "
-                + message)
-
-        # Append the user message to the conversation history
-        messages.append({"role": "user", "content": message})
-
-        # Correct the method call to use the right function
-        response = client.chat.completions.create(model="gpt-3.5-turbo",  # Replace with the desired model (can also use "gpt-3.5-turbo")
-        messages=messages)
-
-        # Extract the reply from the response
-        reply = response.choices[0].message.content
-        print(f"ChatGPT: {reply}")
-
-        with open('output.txt', 'w') as file:
-            file.write(reply)
-
-        lines = reply.split('\n')
-
-        non_empty_lines = [line for line in lines if line]
-
-        labels = ["subjective", "objective", "assessment", "plan", "intervention", "other"]
-
-        json_object = {}
-
-        for i in range(5):
-            json_object[labels[i]] = non_empty_lines[i]
-
-        json_object[labels[5]] = ""
-
-        for i in range(5, len(non_empty_lines)):
-            json_object[labels[5]] += non_empty_lines[i]
-
-        if json_object is not None:
-        # Save to a JSON file
-            with open('output.json', 'w') as json_file:
-                json.dump(json_object, json_file, indent=4)  # Use indent for pretty formatting
-
-
-        # Append the assistant's reply to the conversation history
-        messages.append({"role": "assistant", "content": reply})
-        return json_object
\ No newline at end of file
+        # any failure keeps the transcript, so a retry does not process the audio again
+        return categorize_transcript(message, client, cache)
@@ -0,0 +1,83 @@
+# Rule-based categorizer for formulaic dictation ("Vitals showed BP ... HR ...",
+# "Patient stated ...", "Administered ..."). Each sentence is scored against
+# keyword and pattern sets for every note field; the note is only used when
+# every sentence matches one field clearly, otherwise the LLM categorizes it.
+import re
+
+FIELDS = ("subjective", "objective", "assessment", "plan", "intervention", "other")
+
+# a transcript whose least certain sentence reaches this skips the LLM
+MIN_CONFIDENCE = 0.75
+
+# (pattern, weight) per field; a pattern counts once per sentence however often it matches
+_RULES = {
+    "subjective": [
+        (r"\bpatient (stated|states|said|says|reports?|reported|complains?|complained|describes|described|denies|denied|feels|felt|endorses)\b", 2),
+        (r"\b(c/o|complains? of|history of|hx of|pmh)\b", 2),
+        (r"\bI (feel|have|am|can'?t|don'?t)\b", 1),
+        (r"[\"“‘'][^\"”’']{3,}[\"”’']", 1),
+    ],
+    "objective": [
+        (r"\bvital( sign)?s?\b", 2),
+        (r"\b(bp|blood pressure)\b\D{0,12}\d{2,3}\s*/\s*\d{2,3}", 2),
+        (r"\b(hr|heart rate|pulse|rr|resp(iratory)? rate|spo2|o2 sat\w*|sats?|temp(erature)?)\s*(is|of|was|at|:)?\s*\d{2,3}(\.\d)?\b", 1),
+        (r"\b(mmhg|bpm)\b|°\s*[cf]\b", 1),
+        (r"\b(appeared|appears|observed|noted|on exam(ination)?|auscultat\w*)\b", 2),
+        (r"\b(ct|mri|x-?ray|ekg|ecg|ultrasound|scan|labs?|blood tests?|culture)\b.*\b(shows?|showed|revealed?|within|normal|negative|positive)\b", 2),
+    ],
+    "assessment": [
+        (r"\b((may|might|could) be|possible|possibly|probable|likely|suspect(ed)?|suffering from)\b", 2),
+        (r"\b(consistent with|suggestive of|concern(ed)? for|at risk (of|for)|rule out|r/o|fit for|impression)\b", 2),
+    ],
+    "plan": [
+        (r"^(increase|decrease|prescribe|refer|proceed|continue|monitor|start|begin|discontinue|schedule|recheck|reassess|consult)\b", 2),
+        (r"\b(contacted|notified|paged|called|informed)\b", 2),
+        (r"\b(plan(ned)?|will (continue|monitor|follow|reassess|recheck|start|be)|recommend\w*|follow[- ]up|referr?(al|ed))\b", 1),
+    ],
+    "intervention": [
+        (r"^(administered|provided|gave|performed|applied|placed|inserted|initiated|started|scheduled|educated|repositioned)\b", 2),
+        (r"\b(administered|(was|were) given|given to (the )?patient|provided|applied|performed|inserted)\b", 2),
+        (r"\b(increased|decreased|improved|slowed|rose|fell|dropped|returned) to\b|\b(resolved|tolerated|responded)\b", 2),
+    ],
+    "other": [
+        (r"\b(report (was )?given|hand-?off|transferred|sent to the|discharged|admitted to)\b", 3),
+        (r"\b(advised|encouraged|instructed|consent)\b", 2),
+    ],
+}
+
+# compiled once at import
+RULES = {
+    field: [(re.compile(pattern, re.IGNORECASE), weight) for pattern, weight in rules]
+    for field, rules in _RULES.items()
+}
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+def split_sentences(text):
+    return [sentence.strip() for sentence in _SENTENCE_END.split(text) if sentence.strip()]
+
+# the best field for one sentence and how sure the rules are of it: 1.0 when
+# only one field matches, 0.0 when nothing matches or two fields tie
+def classify_sentence(sentence):
+    scores = {
+        field: sum(weight for pattern, weight in rules if pattern.search(sentence))
+        for field, rules in RULES.items()
+    }
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    (field, best), (_, second) = ranked[0], ranked[1]
+    if not best:
+        return "other", 0.0
+    return field, (best - second) / best
+
+# split a transcript into the note fields; returns the fields and the
+# confidence of the least certain sentence, so one sentence no rule matched
+# (filed under "other" with 0.0) sends the whole transcript to the LLM
+def classify(text):
+    sentences = split_sentences(text)
+    note = {field: [] for field in FIELDS}
+    lowest = None
+    for sentence in sentences:
+        field, confidence = classify_sentence(sentence)
+        note[field].append(sentence)
+        lowest = confidence if lowest is None else min(lowest, confidence)
+    return {field: " ".join(note[field]) for field in FIELDS}, (lowest or 0.0)
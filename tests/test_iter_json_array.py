@@ -0,0 +1,65 @@
+# iter_json_array must yield exactly what json.load would, however the file is
+# split into blocks
+import io
+import json
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('RESULT_CACHE', '0')
+
+from app import iter_json_array
+
+
+def random_value(rng, depth=0):
+    kind = rng.choice(('int', 'float', 'str', 'bool', 'null') + (('list', 'dict') if depth < 3 else ()))
+    if kind == 'int':
+        return rng.randint(-10 ** 6, 10 ** 6)
+    if kind == 'float':
+        return rng.uniform(-1e3, 1e3)
+    if kind == 'str':
+        return ''.join(rng.choice('ab "\\\né中,[]{}') for _ in range(rng.randint(0, 12)))
+    if kind == 'bool':
+        return rng.random() < 0.5
+    if kind == 'null':
+        return None
+    if kind == 'list':
+        return [random_value(rng, depth + 1) for _ in range(rng.randint(0, 4))]
+    return {f'k{i}': random_value(rng, depth + 1) for i in range(rng.randint(0, 4))}
+
+
+def items(text, block_size):
+    return list(iter_json_array(io.StringIO(text), block_size=block_size))
+
+
+class IterJsonArrayTest(unittest.TestCase):
+    def test_matches_json_loads(self):
+        rng = random.Random(10)
+        for case in range(300):
+            value = [random_value(rng) for _ in range(rng.randint(0, 6))]
+            text = json.dumps(value, indent=rng.choice((None, 2)), ensure_ascii=rng.random() < 0.5)
+            block_size = rng.choice((1, 2, 3, 7, 64, 1 << 16))
+            with self.subTest(case=case, block_size=block_size):
+                self.assertEqual(items(text, block_size), json.loads(text))
+
+    def test_patients_json(self):
+        path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'patients.json')
+        with open(path, encoding='utf-8') as f:
+            expected = json.load(f)
+        for block_size in (5, 100, 1 << 16):
+            with open(path, encoding='utf-8') as f:
+                self.assertEqual(list(iter_json_array(f, block_size=block_size)), expected)
+
+    def test_invalid_input(self):
+        for text in ('', '{"a": 1}', '[1 2]', '[1, 2', '[{"a": ]', '[1,, 2]'):
+            for block_size in (1, 1 << 16):
+                with self.subTest(text=text, block_size=block_size):
+                    with self.assertRaises(ValueError):
+                        items(text, block_size)
+
+
+if __name__ == '__main__':
+    unittest.main()
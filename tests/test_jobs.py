@@ -0,0 +1,101 @@
+# JobQueue runs jobs on worker threads, retries failures and reports the outcome
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jobs import JobQueue, PermanentJobError, QueueFull, RetryJob
+
+
+def run_job(func, max_retries=2, **submit):
+    done = threading.Event()
+    finished = []
+
+    def callback(job):
+        finished.append(job)
+        done.set()
+
+    jobs = JobQueue(func, workers=1, max_retries=max_retries, retry_delay=0, on_success=callback, on_failure=callback)
+    job = jobs.submit(**submit)
+    assert done.wait(5), 'the job did not finish'
+    jobs.join()
+    return job, finished
+
+
+class JobQueueTest(unittest.TestCase):
+    def test_success(self):
+        job, finished = run_job(lambda value: value * 2, value=21, context={'patient_id': 7})
+        self.assertEqual(finished, [job])
+        self.assertEqual((job.status, job.result, job.attempts), ('finished', 42, 1))
+        self.assertEqual(job.to_dict()['patient_id'], 7)
+
+    def test_retries_then_succeeds(self):
+        calls = []
+
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise RuntimeError('try again')
+            return 'ok'
+
+        job, _ = run_job(flaky)
+        self.assertEqual((job.status, job.result, job.attempts, job.error), ('finished', 'ok', 3, None))
+
+    def test_gives_up_after_max_retries(self):
+        def broken():
+            raise RuntimeError('still broken')
+
+        job, _ = run_job(broken, max_retries=1)
+        self.assertEqual((job.status, job.attempts, job.error), ('failed', 2, 'still broken'))
+
+    def test_permanent_error_is_not_retried(self):
+        def hopeless():
+            raise PermanentJobError('no speech')
+
+        job, _ = run_job(hopeless)
+        self.assertEqual((job.status, job.attempts, job.error), ('failed', 1, 'no speech'))
+
+    def test_retry_job_replaces_arguments(self):
+        seen = []
+
+        def transcribe(file_path=None, transcript=None):
+            seen.append((file_path, transcript))
+            if transcript is None:
+                raise RetryJob('categorizing failed', transcript='hello')
+            return transcript
+
+        job, _ = run_job(transcribe, file_path='a.wav')
+        self.assertEqual(seen, [('a.wav', None), ('a.wav', 'hello')])
+        self.assertEqual((job.status, job.result), ('finished', 'hello'))
+
+    def test_failing_callback_fails_the_job(self):
+        def save(job):
+            raise RuntimeError('database is locked')
+
+        jobs = JobQueue(lambda: 1, workers=1, retry_delay=0, on_success=save)
+        job = jobs.submit()
+        jobs.join()
+        self.assertEqual((job.status, job.error), ('failed', 'database is locked'))
+
+    def test_queue_full(self):
+        release = threading.Event()
+        jobs = JobQueue(lambda: release.wait(5), workers=1, max_queue=1, retry_delay=0)
+        started = jobs.submit()
+        # wait for the worker to take the first job so exactly one slot is left
+        while jobs.running() == 0:
+            threading.Event().wait(0.01)
+        waiting = jobs.submit()
+        with self.assertRaises(QueueFull):
+            jobs.submit()
+        self.assertEqual(jobs.queue_depth(), 1)
+        release.set()
+        jobs.join()
+        self.assertEqual((started.status, waiting.status), ('finished', 'finished'))
+        self.assertIsNone(jobs.get('missing'))
+        self.assertIs(jobs.get(started.id), started)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# categorize() and categorize_many() over HTTP, through the real OpenAI
+# client and its httpx connection pool, against a chat completions stub
+# served from this process
+import json
+import os
+import sys
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from process_audio import CATEGORIZE_MODEL, CategorizationError, categorize, categorize_many, get_llm_client
+
+
+class ChatCompletionsStub(BaseHTTPRequestHandler):
+    """Files the transcript under subjective, or replies "garbled" (not a note,
+    and still not one when sent back for repair) when the text after ### says so."""
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.requests.append((self.path, body))
+        prompt = body['messages'][-1]['content']
+        transcript = prompt.rsplit('### ', 1)[-1]
+        if 'garbled' in transcript:
+            content = 'garbled'
+        else:
+            content = json.dumps({'subjective': transcript, 'objective': '', 'assessment': '',
+                                  'plan': '', 'intervention': '', 'other': ''})
+        reply = json.dumps({
+            'id': 'chatcmpl-test', 'object': 'chat.completion', 'created': 0, 'model': body['model'],
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': content}}],
+            'usage': {'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15},
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LLMClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ChatCompletionsStub)
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.client = get_llm_client(base_url=f'http://127.0.0.1:{self.server.server_port}/v1')
+
+    def test_categorize(self):
+        note = categorize('the patient is resting', client=self.client, fast_path=False)
+        self.assertEqual(note['subjective'], 'the patient is resting')
+        path, body = self.server.requests[0]
+        self.assertEqual(path, '/v1/chat/completions')
+        self.assertEqual(body['model'], CATEGORIZE_MODEL)
+        self.assertEqual(body['response_format'], {'type': 'json_object'})
+        # the client is shared per base URL
+        self.assertIs(get_llm_client(base_url=f'http://127.0.0.1:{self.server.server_port}/v1'), self.client)
+
+    def test_categorize_many_keeps_the_other_results(self):
+        transcripts = ['first note', 'garbled note', 'third note']
+        results = categorize_many(transcripts, client=self.client, max_workers=3)
+        self.assertEqual(results[0]['subjective'], 'first note')
+        self.assertIsInstance(results[1], CategorizationError)
+        self.assertEqual(results[1].transcript, 'garbled note')
+        self.assertEqual(results[2]['subjective'], 'third note')
+        # the garbled reply got one repair request
+        self.assertEqual(len(self.server.requests), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
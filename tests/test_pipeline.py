@@ -0,0 +1,197 @@
+# The audio-to-note pipeline with in-process stand-ins for the speech
+# recognizer and the LLM, so it runs without network access
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import httpx
+import numpy as np
+import openai
+import speech_recognition as sr
+from pydub import AudioSegment
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('RESULT_CACHE', '0')
+
+import process_audio
+from process_audio import CategorizationError, categorize, categorize_many, run
+
+SAMPLE = os.path.join(ROOT, '16-122828-0002.wav')
+
+
+class StubRecognizer:
+    """Stands in for sr.Recognizer: every chunk says `text`; the first
+    `failures` calls fail as a rate-limited request would."""
+
+    def __init__(self, text='the patient is resting', failures=0):
+        self.text = text
+        self.failures = failures
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def recognize_google(self, audio_data, **kwargs):
+        with self._lock:
+            self.calls += 1
+            if self.calls <= self.failures:
+                raise sr.RequestError('rate limited')
+        return self.text
+
+
+class StubLLM:
+    """Stands in for the OpenAI client: replies with `replies` in turn, or by
+    default files the whole transcript under subjective. The first `failures`
+    requests time out."""
+
+    def __init__(self, replies=(), delay=0, failures=0):
+        self.replies = list(replies)
+        self.delay = delay
+        self.failures = failures
+        self.prompts = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=self)
+
+    def create(self, model, messages, **kwargs):
+        with self._lock:
+            self.prompts.append(messages[-1]['content'])
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            failed = len(self.prompts) <= self.failures
+            reply = None if failed or not self.replies else self.replies.pop(0)
+        try:
+            if failed:
+                raise openai.APITimeoutError(request=httpx.Request('POST', 'http://llm.invalid/chat/completions'))
+            if self.delay:
+                time.sleep(self.delay)
+            if reply is None:
+                transcript = messages[-1]['content'].rsplit('### ', 1)[-1]
+                reply = json.dumps({'subjective': transcript, 'objective': '', 'assessment': '',
+                                    'plan': '', 'intervention': '', 'other': ''})
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=reply))], usage=None)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+class RunTest(unittest.TestCase):
+    def test_run_with_stand_ins(self):
+        recognizer = StubRecognizer()
+        client = StubLLM()
+        note = run(SAMPLE, recognizer=recognizer, client=client, cache=False)
+        self.assertGreater(recognizer.calls, 0)
+        self.assertEqual(len(client.prompts), 1)
+        self.assertTrue(note['subjective'].startswith('The patient is resting.'))
+        self.assertEqual(set(note), set(process_audio.NOTE_FIELDS))
+
+    def test_recognition_requests_are_retried(self):
+        recognizer = StubRecognizer(failures=2)
+        # skip the backoff between retries
+        with mock.patch.object(process_audio.time, 'sleep') as sleep:
+            note = run(SAMPLE, recognizer=recognizer, client=StubLLM(), cache=False)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertTrue(note['subjective'].startswith('The patient is resting.'))
+
+    def test_no_speech_skips_the_llm(self):
+        client = StubLLM()
+        self.assertIsNone(run(SAMPLE, recognizer=StubRecognizer(text=''), client=client, cache=False))
+        self.assertEqual(client.prompts, [])
+
+    def test_llm_failure_keeps_the_transcript(self):
+        with self.assertRaises(CategorizationError) as raised:
+            run(SAMPLE, recognizer=StubRecognizer(), client=StubLLM(failures=1), cache=False)
+        self.assertTrue(raised.exception.transcript.startswith('The patient is resting.'))
+        self.assertIsInstance(raised.exception.__cause__, openai.APITimeoutError)
+
+    def test_job_retry_does_not_process_the_audio_again(self):
+        import app as nurse_app
+        recognizer = StubRecognizer()
+        client = StubLLM(failures=1)
+        with mock.patch.object(nurse_app, 'run', lambda path: run(path, recognizer=recognizer, client=client, cache=False)), \
+                mock.patch.object(nurse_app, 'categorize',
+                                  lambda transcript, cache=None: categorize(transcript, client=client, fast_path=False)):
+            with self.assertRaises(nurse_app.RetryJob) as raised:
+                nurse_app.transcribe_note(file_path=SAMPLE)
+            calls = recognizer.calls
+            note = nurse_app.transcribe_note(**raised.exception.kwargs)
+        self.assertEqual(recognizer.calls, calls)
+        self.assertEqual(len(client.prompts), 2)
+        self.assertTrue(note['subjective'].startswith('The patient is resting.'))
+
+
+class SlowBackend(process_audio.SpeechBackend):
+    """A recognizer slower than decoding; counts the chunks it has finished."""
+    max_workers = 2
+
+    def __init__(self):
+        self.done = 0
+        self._lock = threading.Lock()
+
+    def transcribe_batch(self, chunks):
+        time.sleep(0.02)
+        with self._lock:
+            self.done += len(chunks)
+        return ['word'] * len(chunks)
+
+
+class TranscribeTest(unittest.TestCase):
+    def test_pending_chunks_are_bounded(self):
+        # 60 short tones, each followed by enough silence to split on
+        rng = np.random.default_rng(0)
+        tone = rng.integers(-8000, 8000, 16000 * 300 // 1000).astype(np.int16).tobytes()
+        pcm = (tone + bytes(16000 * 2 * 700 // 1000)) * 60
+        path = os.path.join(tempfile.mkdtemp(prefix='test_pipeline_'), 'tones.wav')
+        AudioSegment(pcm, sample_width=2, frame_rate=16000, channels=1).export(path, format='wav').close()
+
+        backend = SlowBackend()
+        produced, peak = [0], [0]
+        stream_audio_chunks = process_audio.stream_audio_chunks
+
+        def counting(*args, **kwargs):
+            for chunk in stream_audio_chunks(*args, **kwargs):
+                produced[0] += 1
+                peak[0] = max(peak[0], produced[0] - backend.done)
+                yield chunk
+
+        with mock.patch.object(process_audio, 'stream_audio_chunks', counting):
+            transcript = process_audio.get_large_audio_transcription_on_silence(path, backend)
+        self.assertEqual(transcript, 'Word. ' * 60)
+        # decoding waits once 2 * max_workers chunks are queued
+        self.assertLessEqual(peak[0], 2 * backend.max_workers + 1)
+
+
+class CategorizeTest(unittest.TestCase):
+    def test_invalid_reply_is_repaired_once(self):
+        fixed = json.dumps({'subjective': 'a', 'objective': 'b', 'assessment': '', 'plan': '', 'intervention': ''})
+        client = StubLLM(replies=['not json', fixed])
+        note = categorize('a b', client=client, fast_path=False)
+        self.assertEqual((note['subjective'], note['objective'], note['other']), ('a', 'b', ''))
+        self.assertEqual(len(client.prompts), 2)
+
+    def test_unrepairable_reply_keeps_the_transcript(self):
+        client = StubLLM(replies=['not json', '{"subjective": 1}'])
+        with self.assertRaises(CategorizationError) as raised:
+            categorize('a b', client=client, fast_path=False)
+        self.assertEqual(raised.exception.transcript, 'a b')
+
+    def test_categorize_many(self):
+        client = StubLLM(delay=0.05)
+        transcripts = [f'note {i % 6}' for i in range(12)]
+        notes = categorize_many(transcripts, client=client, max_workers=4)
+        # input order, each distinct transcript sent once, at most max_workers at a time
+        self.assertEqual([note['subjective'] for note in notes], transcripts)
+        self.assertEqual(len(client.prompts), 6)
+        self.assertLessEqual(client.max_in_flight, 4)
+        self.assertGreater(client.max_in_flight, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+# SilenceSegmenter must split a recording exactly as pydub's split_on_silence
+# (seek_step=1) does, whatever block sizes the audio arrives in
+import os
+import random
+import sys
+import unittest
+
+import numpy as np
+from pydub import AudioSegment
+from pydub.silence import split_on_silence
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from process_audio import STREAM_SAMPLE_WIDTH, SilenceSegmenter
+
+SILENCE_THRESH = -40
+
+
+# Alternating quiet and loud stretches of random length, as 16-bit mono PCM
+def random_recording(rng, sample_rate):
+    parts = []
+    loud = rng.random() < 0.5
+    for _ in range(rng.randint(1, 8)):
+        samples = sample_rate * rng.randint(20, 1200) // 1000
+        amplitude = rng.choice((3000, 8000, 20000)) if loud else rng.choice((0, 10, 50))
+        noise = np.random.default_rng(rng.randrange(1 << 30)).integers(-amplitude, amplitude + 1, samples)
+        parts.append(noise.astype(np.int16))
+        loud = not loud
+    return np.concatenate(parts).tobytes()
+
+
+def segment(pcm, sample_rate, rng, **settings):
+    segmenter = SilenceSegmenter(sample_rate, silence_thresh=SILENCE_THRESH, max_chunk_len=None, **settings)
+    chunks = []
+    pos = 0
+    while pos < len(pcm):
+        # blocks of any size, including ones that split a sample
+        size = rng.randint(1, 4000)
+        chunks.extend(segmenter.feed(pcm[pos:pos + size]))
+        pos += size
+    chunks.extend(segmenter.flush())
+    return [chunk.get_raw_data() for chunk in chunks]
+
+
+class SilenceSegmenterTest(unittest.TestCase):
+    def test_matches_split_on_silence(self):
+        rng = random.Random(4)
+        for case in range(200):
+            sample_rate = rng.choice((8000, 16000))
+            settings = {
+                'min_silence_len': rng.choice((50, 100, 300, 500, 700)),
+                'keep_silence': rng.choice((0, 100, 250, 500)),
+            }
+            pcm = random_recording(rng, sample_rate)
+            sound = AudioSegment(data=pcm, sample_width=STREAM_SAMPLE_WIDTH, frame_rate=sample_rate, channels=1)
+            expected = [chunk.raw_data for chunk in split_on_silence(
+                sound, silence_thresh=SILENCE_THRESH, seek_step=1, **settings)]
+            with self.subTest(case=case, sample_rate=sample_rate, **settings):
+                self.assertEqual(segment(pcm, sample_rate, rng, **settings), expected)
+
+    def test_cuts_speech_without_pauses(self):
+        pcm = np.random.default_rng(1).integers(-8000, 8001, 8000 * 5).astype(np.int16).tobytes()
+        segmenter = SilenceSegmenter(8000, silence_thresh=SILENCE_THRESH, max_chunk_len=2000)
+        chunks = segmenter.feed(pcm) + segmenter.flush()
+        self.assertEqual([len(chunk.get_raw_data()) // (8 * STREAM_SAMPLE_WIDTH) for chunk in chunks], [2000, 2000, 1000])
+        self.assertEqual(b''.join(chunk.get_raw_data() for chunk in chunks), pcm)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+# stream_pcm must keep decoding when ffmpeg writes more errors than the
+# stderr pipe holds, as it does for a long recording with damaged frames
+import os
+import stat
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import process_audio
+from process_audio import STREAM_STDERR_TAIL_BYTES, stream_pcm
+
+# stands in for ffmpeg: 1 MB of errors (far more than a pipe buffer), then
+# 10 seconds of silent PCM, then the exit status given as the last argument
+NOISY_CONVERTER = """#!{python}
+import sys
+for i in range(20000):
+    sys.stderr.write("[mp3float @ 0x1] Header missing, frame %d\\n" % i)
+sys.stderr.flush()
+sys.stdout.buffer.write(bytes(16000 * 2 * 10))
+sys.stdout.flush()
+sys.exit(int(sys.argv[-1]) if sys.argv[-1].isdigit() else 0)
+"""
+
+
+class StreamPcmTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='test_stream_pcm_')
+        self.converter = os.path.join(self.workdir, 'ffmpeg')
+        with open(self.converter, 'w') as f:
+            f.write(NOISY_CONVERTER.format(python=sys.executable))
+        os.chmod(self.converter, os.stat(self.converter).st_mode | stat.S_IEXEC)
+
+    def decode(self, *extra):
+        result = {}
+
+        def target():
+            try:
+                result['bytes'] = sum(len(block) for block in stream_pcm(self.converter))
+            except Exception as e:
+                result['error'] = e
+
+        # the converter's last argument is the output ("-"); append the exit status after it
+        original = process_audio.subprocess.Popen
+        with mock.patch.object(process_audio.AudioSegment, 'converter', self.converter), \
+                mock.patch.object(process_audio.subprocess, 'Popen',
+                                  lambda command, **kwargs: original(command + list(extra), **kwargs)):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            thread.join(30)
+        self.assertFalse(thread.is_alive(), 'stream_pcm deadlocked on a full stderr pipe')
+        return result
+
+    def test_decodes_despite_error_output(self):
+        self.assertEqual(self.decode(), {'bytes': 16000 * 2 * 10})
+
+    def test_failure_reports_the_tail_of_the_errors(self):
+        error = self.decode('1')['error']
+        self.assertIsInstance(error, RuntimeError)
+        self.assertIn('frame 19999', str(error))
+        self.assertLess(len(str(error)), STREAM_STDERR_TAIL_BYTES + 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# Uploads wait in the job queue, so every upload needs a file of its own
+import io
+import os
+import sys
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('RESULT_CACHE', '0')
+
+import app as nurse_app
+from werkzeug.security import generate_password_hash
+
+SAMPLE = os.path.join(ROOT, '16-122828-0002.wav')
+
+
+class UploadTest(unittest.TestCase):
+    def setUp(self):
+        folder = tempfile.mkdtemp(prefix='test_uploads_')
+        config = mock.patch.dict(nurse_app.app.config, {'UPLOAD_FOLDER': folder})
+        config.start()
+        self.addCleanup(config.stop)
+        with nurse_app.app.app_context():
+            nurse_app.db.drop_all()
+            nurse_app.db.create_all()
+            nurse_app.db.session.add(nurse_app.Patient(id=1, name='Test Patient', age=40))
+            nurse_app.db.session.add(nurse_app.User(username='nurse', password_hash=generate_password_hash('secret')))
+            nurse_app.db.session.commit()
+        self.client = nurse_app.app.test_client()
+        self.client.post('/login', data={'username': 'nurse', 'password': 'secret'})
+        self.submitted = []
+
+        def submit(**kwargs):
+            self.submitted.append(kwargs)
+            return SimpleNamespace(to_dict=lambda: {'id': str(len(self.submitted))})
+
+        jobs = mock.patch.object(nurse_app.note_jobs, 'submit', submit)
+        jobs.start()
+        self.addCleanup(jobs.stop)
+
+    def test_same_named_uploads_get_their_own_files(self):
+        with open(SAMPLE, 'rb') as f:
+            recording = f.read()
+        for _ in range(2):
+            response = self.client.post('/patient/1/add_note', headers={'Accept': 'application/json'},
+                                        data={'audio': (io.BytesIO(recording), 'note.wav')})
+            self.assertEqual(response.status_code, 202)
+        paths = [kwargs['file_path'] for kwargs in self.submitted]
+        self.assertEqual(len(set(paths)), 2)
+        for path in paths:
+            self.assertTrue(path.endswith('_note.wav'))
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), recording)
+
+    def test_same_named_streams_get_their_own_files(self):
+        transcribe = mock.patch.object(nurse_app, 'transcribe_stream',
+                                       lambda stream, copy_to: copy_to.write(stream.read()) and 'the patient is resting')
+        transcribe.start()
+        self.addCleanup(transcribe.stop)
+        for body in (b'first recording', b'second recording'):
+            response = self.client.post('/patient/1/add_note/stream?filename=note.wav', data=body)
+            self.assertEqual(response.status_code, 202)
+        contents = []
+        for kwargs in self.submitted:
+            with open(kwargs['file_path'], 'rb') as f:
+                contents.append(f.read())
+        self.assertEqual(contents, [b'first recording', b'second recording'])
+
+
+if __name__ == '__main__':
+    unittest.main()